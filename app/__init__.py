@@ -8,6 +8,7 @@ from flask_wtf.csrf import CSRFProtect
 from flask_moment import Moment
 
 from .decorators import no_cache, rate_limit
+from .json_provider import FastJSONProvider
 from .models import db, login_manager
 
 bootstrap = Bootstrap()
@@ -25,6 +26,10 @@ def create_app(config_name):
     app.config.from_pyfile(cfg)
     app.config['UPLOADS_DEFAULT_DEST'] = os.path.join(os.getcwd(), 'uploads')
 
+    # encode JSON responses with the faster provider
+    app.json = FastJSONProvider(app)
+    app.json.sort_keys = app.config.get('JSON_SORT_KEYS', True)
+
     # initialize extensions
     db.init_app(app)
     csrf.init_app(app)
@@ -54,6 +59,10 @@ def create_app(config_name):
     csrf.exempt(login_api)
     csrf.exempt(mobile_api)
 
+    # apply the version bumps other workers could not send to Redis
+    from .models import PendingBump
+    app.before_request(PendingBump.apply)
+
     # register an after request handler
     @app.after_request
     def after_request(rv):
@@ -0,0 +1,441 @@
+import json
+import os
+import threading
+from time import time
+
+import redis
+from flask import current_app
+
+from .utils import log_activity
+
+tragel_companies_tag = 'tragel:companies'
+tragel_versions_tag = 'tragel:versions'
+tragel_catalog_tag = 'tragel:catalog'
+tragel_count_tag = 'tragel:count'
+tragel_identity_tag = 'tragel:identity'
+
+_client = None
+_breaker = None
+_scripts = {}
+_lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+    """Stop calling a failing service for a while. After `threshold`
+    consecutive failures the breaker opens and `allow` refuses calls for
+    `retry_after` seconds, then lets calls through again; the next failure
+    opens it again right away."""
+    def __init__(self, threshold, retry_after):
+        self.threshold = threshold
+        self.retry_after = retry_after
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        return self.opened_at is None or \
+            time() - self.opened_at >= self.retry_after
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        """Record a failure. Returns True when this opens the breaker."""
+        self.failures += 1
+        if self.failures >= self.threshold:
+            was_closed = self.opened_at is None
+            self.opened_at = time()
+            return was_closed
+        return False
+
+
+def get_client():
+    """Return the Redis client of the application, creating its connection
+    pool on first use from the REDIS_* configuration."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = redis.StrictRedis(connection_pool=_create_pool(
+                    current_app.config))
+    return _client
+
+
+def _create_pool(config):
+    options = {
+        'max_connections': config.get('REDIS_MAX_CONNECTIONS', 50),
+        # how long a request waits for a free connection of the pool
+        'timeout': config.get('REDIS_POOL_TIMEOUT', 0.2),
+        'socket_timeout': config.get('REDIS_SOCKET_TIMEOUT', 0.5),
+        'socket_connect_timeout': config.get('REDIS_CONNECT_TIMEOUT', 0.5),
+    }
+    if config.get('REDIS_URL'):
+        return redis.BlockingConnectionPool.from_url(config['REDIS_URL'],
+                                                     **options)
+    return redis.BlockingConnectionPool(
+        host=config.get('REDIS_HOST', 'localhost'),
+        port=int(config.get('REDIS_PORT', os.environ.get('redis_port', 6379))),
+        password=config.get('REDIS_PASSWORD', os.environ.get('redis_pass')),
+        **options)
+
+
+def _get_breaker():
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker(
+            current_app.config.get('REDIS_FAILURE_THRESHOLD', 3),
+            current_app.config.get('REDIS_RETRY_AFTER', 30))
+    return _breaker
+
+
+def is_available():
+    """False while Redis is considered down."""
+    return _get_breaker().allow()
+
+
+def run(operation, default=None):
+    """Call `operation` with the Redis client and return its result, or
+    `default` if Redis is down or the call fails. Callers must treat the
+    default as a cache miss and fall back to the database."""
+    breaker = _get_breaker()
+    if not breaker.allow():
+        return default
+    try:
+        result = operation(get_client())
+    except redis.RedisError as e:
+        if breaker.failure():
+            log_activity('CACHE[unavailable]', '', '', str(e))
+        return default
+    breaker.success()
+    return result
+
+
+def retry_pending():
+    """Retry the version bumps and invalidations that could not reach Redis.
+    Readers call this first, so that a change is never hidden for longer
+    than Redis is unreachable; what is still pending afterwards must be
+    read from the database."""
+    if _pending_bumps:
+        bump_resource_versions(None)
+    if _pending_identities:
+        invalidate_identities(())
+    if _pending_cities:
+        invalidate_companies_in_cities(())
+
+
+def _script(source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = get_client().register_script(source)
+    return script
+
+
+# Versions ####################################################################
+
+# Every (resource, company) pair has a version counter, bumped after each
+# commit writing the resource (a table) for that company. Cached values are
+# stored with the version they were built from and ignored once it moved.
+# Bumps that could not reach Redis are retried with the next ones, and
+# saved in the database for the other workers (see `PendingBump`).
+_pending_bumps = set()
+
+# The hash of the counters also holds a random epoch, created along with
+# it. When Redis loses the hash (a flush, or a restart without persistence)
+# the counters start again from 0 under a new epoch, so a version handed
+# out before, such as the one in the ETag held by a client, never comes
+# back. Versions are given out as '<epoch>.<counter>' strings.
+_epoch_field = '_epoch'
+
+
+def resource_version_key(resource, company_id):
+    return '{}:{}'.format(resource, company_id)
+
+
+def _fetch_versions(pipeline, resources, company_id):
+    pipeline.hsetnx(tragel_versions_tag, _epoch_field, os.urandom(8).hex())
+    pipeline.hmget(tragel_versions_tag, [_epoch_field] + [
+        resource_version_key(resource, company_id) for resource in resources])
+
+
+def _format_versions(values):
+    epoch = _decode(values[0])
+    return ['{}.{}'.format(epoch, int(value or 0)) for value in values[1:]]
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def bump_resource_versions(changes):
+    """Increment the version counter of every (resource, company_id) pair in
+    `changes`. Returns the pairs whose bump is still pending."""
+    if changes:
+        _pending_bumps.update(changes)
+    if not _pending_bumps:
+        return set()
+    bumps = list(_pending_bumps)
+
+    def bump(client):
+        pipeline = client.pipeline(transaction=False)
+        for resource, company_id in bumps:
+            pipeline.hincrby(tragel_versions_tag,
+                             resource_version_key(resource, company_id), 1)
+        return pipeline.execute()
+
+    if run(bump) is not None:
+        _pending_bumps.difference_update(bumps)
+    return set(_pending_bumps)
+
+
+def resource_version(resource, company_id):
+    """Current version of a resource, or None if Redis is down or the
+    resource has a bump pending."""
+    versions = resource_versions([resource], company_id)
+    return None if versions is None else versions[0]
+
+
+def resource_versions(resources, company_id):
+    """Current versions of several resources of a company, read in a single
+    round trip, or None if Redis is down or one of them has a bump
+    pending."""
+    retry_pending()
+    if any((resource, company_id) in _pending_bumps
+           for resource in resources):
+        return None
+
+    def fetch(client):
+        pipeline = client.pipeline(transaction=False)
+        _fetch_versions(pipeline, resources, company_id)
+        return pipeline.execute()
+
+    result = run(fetch)
+    return None if result is None else _format_versions(result[1])
+
+
+def get_versioned(key, resource, company_id):
+    """Return (version, value): the current version of the resource and the
+    value cached at `key`, or None if it was built from another version.
+    Both are None if Redis is down or the resource has a bump pending. Takes
+    a single round trip."""
+    retry_pending()
+    if (resource, company_id) in _pending_bumps:
+        return None, None
+
+    def fetch(client):
+        pipeline = client.pipeline(transaction=False)
+        _fetch_versions(pipeline, [resource], company_id)
+        pipeline.hmget(key, 'version', 'value')
+        return pipeline.execute()
+
+    result = run(fetch)
+    if result is None:
+        return None, None
+    _, versions, (cached_version, value) = result
+    version = _format_versions(versions)[0]
+    if _decode(cached_version) != version:
+        return version, None
+    return version, value
+
+
+def set_versioned(key, version, value, ttl):
+    """Cache `value`, built from `version` of its resource, at `key`."""
+    if version is None:
+        return
+
+    def store(client):
+        pipeline = client.pipeline()
+        pipeline.hset(key, mapping={'version': version, 'value': value})
+        pipeline.expire(key, ttl)
+        return pipeline.execute()
+    run(store)
+
+
+# Companies by city ###########################################################
+
+# The companies of a city are cached as one hash per city, with a field per
+# company holding its encoded JSON and a '_' field so that empty cities are
+# cached too. Every write to the companies of a city increments the city's
+# generation counter, and a hash built from the database is only stored if
+# the generation did not move while it was being built, so a concurrent
+# write can never be lost.
+_populate_city_script = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('del', KEYS[1])
+redis.call('hset', KEYS[1], '_', '')
+for i = 3, #ARGV, 2 do
+    redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+"""
+_add_to_city_script = """
+redis.call('incr', KEYS[2])
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+_invalidate_city_script = """
+redis.call('incr', KEYS[2])
+if ARGV[1] == '1' then
+    redis.call('del', KEYS[1])
+end
+"""
+_pending_cities = {}
+
+
+def _city_keys(city_id):
+    key = '{}:{}'.format(tragel_companies_tag, city_id)
+    return [key, key + ':generation']
+
+
+def cached_companies_in_city(city_id):
+    """Return (generation, entries) for a city; `entries` is the list of
+    encoded companies ordered by id, or None if the city is not cached.
+    Both are None if Redis is down or the city has an invalidation
+    pending."""
+    retry_pending()
+    if city_id in _pending_cities:
+        return None, None
+    hash_key, generation_key = _city_keys(city_id)
+
+    def fetch(client):
+        pipeline = client.pipeline(transaction=False)
+        pipeline.get(generation_key)
+        pipeline.hgetall(hash_key)
+        return pipeline.execute()
+
+    result = run(fetch)
+    if result is None:
+        return None, None
+    generation, entries = result
+    generation = (generation or b'0').decode('utf-8')
+    if not entries:
+        return generation, None
+    entries.pop(b'_', None)
+    return generation, [entries[field].decode('utf-8') for field in
+                        sorted(entries, key=int)]
+
+
+def cache_companies_in_city(city_id, generation, entries):
+    """Store the (company_id, encoded company) pairs of a city, unless the
+    city was written to since `generation` was read."""
+    if generation is None:
+        return
+    arguments = [generation, current_app.config.get('COMPANIES_CACHE_TTL',
+                                                    600)]
+    for company_id, encoded in entries:
+        arguments.extend((company_id, encoded))
+    run(lambda client: _script(_populate_city_script)(
+        keys=_city_keys(city_id), args=arguments, client=client))
+
+
+def cache_company(company):
+    """Add a new company to the cached companies of its city."""
+    encoded = current_app.json.dumps(company.to_json(with_isoformat=True))
+    result = run(lambda client: _script(_add_to_city_script)(
+        keys=_city_keys(company.city_id), args=[company.id, encoded],
+        client=client), default=False)
+    if result is False:
+        invalidate_companies_in_cities([company.city_id])
+
+
+def invalidate_companies_in_cities(city_ids, drop=True):
+    """Mark the companies of the cities as changed. With `drop`, their
+    cached entries are removed as well, to be rebuilt on the next read."""
+    for city_id in city_ids:
+        _pending_cities[city_id] = _pending_cities.get(city_id, False) or drop
+    if not _pending_cities:
+        return
+    cities = list(_pending_cities.items())
+
+    def invalidate(client):
+        pipeline = client.pipeline(transaction=False)
+        for city_id, drop_entries in cities:
+            _script(_invalidate_city_script)(
+                keys=_city_keys(city_id), args=['1' if drop_entries else '0'],
+                client=pipeline)
+        return pipeline.execute()
+
+    if run(invalidate) is not None:
+        for city_id, _ in cities:
+            _pending_cities.pop(city_id, None)
+
+
+# Identities ##################################################################
+
+# The identity of a user (the few columns needed to authenticate requests)
+# is cached under the user's id, with a generation counter incremented on
+# every change of the user, so that an identity read from the database
+# before a change is never stored after it.
+_set_if_generation_script = """
+if (redis.call('get', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+_invalidate_script = """
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[1])
+redis.call('del', KEYS[1])
+"""
+_pending_identities = set()
+
+
+def _identity_keys(user_id):
+    key = '{}:{}'.format(tragel_identity_tag, user_id)
+    return [key, key + ':generation']
+
+
+def cached_identity(user_id):
+    """Return (generation, identity) for a user; the identity is None if it
+    is not cached. Both are None if Redis is down or the user has an
+    invalidation pending."""
+    retry_pending()
+    if user_id in _pending_identities:
+        return None, None
+
+    def fetch(client):
+        pipeline = client.pipeline(transaction=False)
+        for key in _identity_keys(user_id):
+            pipeline.get(key)
+        return pipeline.execute()
+
+    result = run(fetch)
+    if result is None:
+        return None, None
+    identity, generation = result
+    generation = (generation or b'0').decode('utf-8')
+    return generation, json.loads(identity) if identity else None
+
+
+def cache_identity(user_id, generation, identity):
+    """Store the identity of a user, unless it changed since `generation`
+    was read."""
+    if generation is None:
+        return
+    ttl = current_app.config.get('IDENTITY_CACHE_TTL', 300)
+    run(lambda client: _script(_set_if_generation_script)(
+        keys=_identity_keys(user_id),
+        args=[generation, json.dumps(identity), ttl], client=client))
+
+
+def invalidate_identities(user_ids):
+    _pending_identities.update(user_ids)
+    if not _pending_identities:
+        return
+    users = list(_pending_identities)
+    # the generation must outlive the identities it protects
+    ttl = current_app.config.get('IDENTITY_CACHE_TTL', 300) * 2
+
+    def invalidate(client):
+        pipeline = client.pipeline(transaction=False)
+        for user_id in users:
+            _script(_invalidate_script)(keys=_identity_keys(user_id),
+                                        args=[ttl], client=pipeline)
+        return pipeline.execute()
+
+    if run(invalidate) is not None:
+        _pending_identities.difference_update(users)
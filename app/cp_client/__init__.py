@@ -26,4 +26,5 @@ def after_request(rv):
     return rv
 
 
-from . import products, orders, users, company, subscription, uploads
+from . import products, orders, users, company, subscription, uploads, \
+    reports
@@ -9,7 +9,7 @@ from ..utils import send_response, log_activity
 
 
 @api.route('/companies/', methods=['GET'])
-@paginate('companies')
+@paginate('companies', serializer=Company.to_json_list, count='cached')
 @sudo_required
 def get_companies():
     return Company.query.order_by(Company.id)
@@ -1,30 +1,37 @@
 import base64
-from datetime import datetime
+import csv
+import io
+from datetime import datetime, time, timedelta
 
-from flask import request, jsonify, abort
+from flask import request, jsonify, current_app, Response, \
+    stream_with_context
 from flask_login import login_required, current_user
-from sqlalchemy import Date, cast
+from sqlalchemy.orm import aliased
 
 from . import v1_api as api
 from .. import db
-from ..decorators import paginate, permission_required, UserType, fully_subscribed
-from ..models import Order, User, Confirmation
+from ..decorators import paginate, permission_required, UserType, \
+    fully_subscribed, versioned_etag
+from ..models import Order, User, Confirmation, Item, Product, DailySale
 from ..utils import send_response, log_activity, \
     date_from_string, SearchType, PaymentType
 
+# the tables read by `Order.to_json_list`
+_order_resources = (Order.__tablename__, User.__tablename__,
+                    Product.__tablename__)
+
 
 @api.route('/orders/', methods=['GET'])
 @permission_required(UserType.Administrator)
-@paginate('orders')
 @fully_subscribed
+@versioned_etag(*_order_resources)
+@paginate('orders', serializer=Order.to_json_list,
+          keyset=(Order.date_of_order, Order.id), descending=True,
+          count='estimated')
 def get_orders():
     date_from = date_from_string(request.args.get('from'), None)
     date_to = date_from_string(request.args.get('to'), None)
 
-    cast_date_from, cast_date_to = None, None
-    if date_from and date_to:
-        cast_date_from = cast(Order.date_of_order, Date)
-        cast_date_to = cast(Order.date_of_order, Date)
     query = Order.query.filter_by(company_id=current_user.company_id)
     if request.args.get('all'):
         return query.order_by(Order.date_of_order.desc())
@@ -36,32 +43,41 @@ def get_orders():
                 return query.filter_by(payment_reference=payment_reference_id)\
                     .order_by(Order.date_of_order.desc())
             else:
-                query = query.filter(cast_date_from >= date_from,
-                                     cast_date_to <= date_to)
+                query = _within_dates(query, date_from, date_to)
                 if payment_reference_id != 'cash':
                     return query.filter_by(payment_reference=payment_reference_id)\
                         .order_by(Order.date_of_order.desc())
                 return query.filter_by(payment_type=PaymentType.Cash)\
                     .order_by(Order.date_of_order.desc())
         elif search_type in (SearchType.BY_PUBLIC_USER, SearchType.BY_COMPANY_USER):
-            username = request.args.get('username')
-            user = User.query.filter_by(username=username).first()
-            if not user:
-                abort(400)
-            query = query.filter_by(staff_id=user.id)
-            if not any((date_from, date_to)):
-                return query.order_by(Order.date_of_order.desc())
-            else:
-                return query.filter(cast_date_from >= date_from,
-                                    cast_date_to <= date_to)\
-                    .order_by(Order.date_of_order.desc())
-    return query.filter(cast_date_from >= date_from, cast_date_to <= date_to)\
+            # an unknown username gives an empty page
+            query = query.join(User, User.id == Order.staff_id).filter(
+                User.username == request.args.get('username'),
+                User.company_id == current_user.company_id)
+            return _within_dates(query, date_from, date_to)\
+                .order_by(Order.date_of_order.desc())
+    return _within_dates(query, date_from, date_to)\
         .order_by(Order.date_of_order.desc())
 
 
+def _within_dates(query, date_from, date_to):
+    """Restrict an order query to the days from `date_from` to `date_to`
+    included. The bounds are compared to the column itself, as a half-open
+    datetime range, so that the (company_id, ..., date_of_order) indexes can
+    be used; either bound may be None."""
+    if date_from is not None:
+        query = query.filter(
+            Order.date_of_order >= datetime.combine(date_from, time.min))
+    if date_to is not None:
+        query = query.filter(Order.date_of_order < datetime.combine(
+            date_to + timedelta(days=1), time.min))
+    return query
+
+
 @api.route('/orders/<int:order_id>', methods=['GET'])
 @permission_required(UserType.Administrator)
 @fully_subscribed
+@versioned_etag(*_order_resources)
 def get_customer_orders(order_id):
     order = Order.query.filter_by(company_id=current_user.company_id,
                                   id=order_id).first()
@@ -95,18 +111,116 @@ def confirm_customer_order():
 @api.route('/orders/count', methods=['GET'])
 @permission_required(UserType.Administrator)
 @fully_subscribed
+@versioned_etag(Order.__tablename__)
 def order_count():
     count = Order.query.filter_by(company_id=current_user.company_id).count()
     return send_response(200, {'count': count})
 
 
+@api.route('/orders/export', methods=['GET'])
+@permission_required(UserType.Administrator)
+@fully_subscribed
+@versioned_etag(*_order_resources)
+def export_orders():
+    """Stream the orders between `from` and `to` (both optional) as NDJSON,
+    one order per line in the `Order.to_json` format, or as CSV with one
+    line per item. Rows are read with a server-side cursor and written as
+    they come, so memory does not depend on the size of the range."""
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return send_response(400, 'Unsupported export format')
+    date_from = date_from_string(request.args.get('from'), None)
+    date_to = date_from_string(request.args.get('to'), None)
+
+    staff, admin = aliased(User), aliased(User)
+    query = db.session.query(
+        Order.id, Order.date_of_order, Order.payment_type,
+        Order.payment_reference, staff.fullname.label('staff'),
+        Product.name.label('product'), Item.quantity, Product.price,
+        Confirmation.confirmed, admin.fullname.label('confirmed_by'),
+        Confirmation.date.label('confirmed_on'))\
+        .outerjoin(staff, staff.id == Order.staff_id)\
+        .outerjoin(Item, Item.order_id == Order.id)\
+        .outerjoin(Product, Product.id == Item.product_id)\
+        .outerjoin(Confirmation, Confirmation.order_id == Order.id)\
+        .outerjoin(admin, admin.id == Confirmation.admin_id)\
+        .filter(Order.company_id == current_user.company_id,
+                Order.deleted == False)
+    rows = _within_dates(query, date_from, date_to)\
+        .order_by(Order.date_of_order, Order.id, Item.id).yield_per(1000)
+
+    if export_format == 'csv':
+        body, mimetype = _orders_as_csv(rows), 'text/csv'
+    else:
+        body, mimetype = _orders_as_ndjson(rows), 'application/x-ndjson'
+    filename = 'orders.' + export_format
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename=' + filename})
+
+
+def _orders_as_ndjson(rows, orders_per_chunk=500):
+    def order_json(row):
+        result = {'id': row.id, 'staff': row.staff,
+                  'payment_type': row.payment_type,
+                  'payment_reference': row.payment_reference,
+                  'date': row.date_of_order.isoformat()
+                  if row.date_of_order else None, 'items': []}
+        if row.confirmed is not None:
+            result['confirmation'] = {'confirmed': row.confirmed}
+            if row.confirmed == 1:
+                result['confirmation']['by'] = row.confirmed_by
+                result['confirmation']['date'] = row.confirmed_on.isoformat() \
+                    if row.confirmed_on else None
+        return result
+
+    dumps = current_app.json.dumps
+    chunk, order = [], None
+    for row in rows:
+        # rows of the same order are consecutive, one per item
+        if order is None or order['id'] != row.id:
+            if order is not None:
+                chunk.append(dumps(order) + '\n')
+                if len(chunk) >= orders_per_chunk:
+                    yield ''.join(chunk)
+                    chunk = []
+            order = order_json(row)
+        if row.product is not None:
+            order['items'].append({'product': row.product,
+                                   'quantity': row.quantity,
+                                   'price': row.price})
+    if order is not None:
+        chunk.append(dumps(order) + '\n')
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _orders_as_csv(rows, rows_per_chunk=1000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['order_id', 'date', 'staff', 'payment_type',
+                     'payment_reference', 'product', 'quantity', 'price',
+                     'confirmed', 'confirmed_by', 'confirmed_on'])
+    for count, row in enumerate(rows, 1):
+        writer.writerow([row.id, row.date_of_order.isoformat()
+                         if row.date_of_order else '', row.staff,
+                         row.payment_type, row.payment_reference, row.product,
+                         row.quantity, row.price, bool(row.confirmed),
+                         row.confirmed_by, row.confirmed_on.isoformat()
+                         if row.confirmed_on else ''])
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
 @api.route('/orders/', methods=['POST'])
 @login_required
 def new_customer_order():
     order_data = request.get_json()
     if order_data is None:
         return send_response(406, 'This request contains invalid or no data')
-    result_tuple = Order.import_data(order_data)
+    result_tuple = Order.import_data(order_data, current_user.company_id)
     if not result_tuple:
         return send_response(404, 'Missing data in order form')
     payment_id, payment_method, order_list = result_tuple
@@ -115,6 +229,10 @@ def new_customer_order():
                       company_id=current_user.company_id, items=order_list)
     try:
         db.session.add(new_order)
+        DailySale.record(current_user.company_id, new_order.date_of_order.date(),
+                         payment_method, [(item.product_id, item.quantity,
+                                           item.price)
+                                          for item in order_list])
         db.session.commit()
         return send_response(200, 'Order created successfully')
     except Exception as e:
@@ -125,6 +243,32 @@ def new_customer_order():
                                   'in your request')
 
 
+@api.route('/orders/batch', methods=['POST'])
+@login_required
+def new_customer_orders():
+    """Create many orders in one request, e.g. the orders a point of sale
+    device took while offline: {"orders": [{"key": ..., "payment_reference_id":
+    ..., "items": [...]}, ...]}. The client generates a unique `key` per
+    order, and an order submitted again with the same key is not created
+    twice: it gets the result of the first submission."""
+    batch = request.get_json()
+    orders = batch.get('orders') if isinstance(batch, dict) else None
+    if not isinstance(orders, list) or not orders:
+        return send_response(406, 'This request contains invalid or no data')
+    if len(orders) > current_app.config.get('ORDER_BATCH_MAX_SIZE', 200):
+        return send_response(413, 'Too many orders in the batch')
+    try:
+        results = Order.submit_batch(orders, current_user.company_id,
+                                     current_user.id)
+    except Exception as e:
+        db.session.rollback()
+        log_activity('EXCEPTION[new_customer_orders]', current_user.username,
+                     '', str(e))
+        return send_response(404, 'There was an error processing the data sent '
+                                  'in your request')
+    return send_response(200, results)
+
+
 @api.route('/orders/', methods=['DELETE'])
 @permission_required(UserType.Administrator)
 @fully_subscribed
@@ -135,6 +279,11 @@ def delete_order():
                                   id=order_id).first()
     if order is not None:
         order.deleted = True
+        DailySale.record(order.company_id, order.date_of_order.date(),
+                         order.payment_type, db.session.query(
+                             Item.product_id, Item.quantity,
+                             Item.price).filter_by(order_id=order.id),
+                         sign=-1)
         db.session.commit()
         log_activity('DELETION[orders]', current_user.username,
                      current_user.company_id, reason)
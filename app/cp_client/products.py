@@ -1,17 +1,24 @@
-from flask import request, jsonify
+import csv
+import io
+
+from flask import request, jsonify, current_app
 from flask_login import login_required, current_user
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from . import v1_api as api
 from .. import db
 from ..decorators import paginate, UserType, permission_required, \
-    fully_subscribed
+    fully_subscribed, versioned_etag
 from ..models import Product
 from ..utils import send_response, log_activity
 
 
 @api.route('/products/', methods=['GET'])
 @login_required
-@paginate('products')
+@versioned_etag(Product.__tablename__)
+@paginate('products', columns=Product.json_columns(),
+          serializer=Product.rows_to_json, keyset=(Product.id,),
+          count='cached')
 def get_products():
     return Product.query.filter_by(company_id=current_user.company_id)\
         .order_by(Product.id)
@@ -43,6 +50,58 @@ def new_product():
     return send_response(200, 'Products added')
 
 
+@api.route('/products/import', methods=['POST'])
+@permission_required(UserType.Administrator)
+@fully_subscribed
+def import_products():
+    """Add the products of a large catalog upload: CSV with a header line
+    (`format=csv` or a text/csv body) using the keys of the JSON format
+    (name, price, thumbnail, desc, cat), or NDJSON with one product object
+    per line. The body is parsed as it is read. Valid products are added,
+    and the others are reported with their line number. Products are saved
+    a chunk at a time, so an upload that fails midway still answers with
+    the number of products saved before the failure."""
+    # above the size limit of the other requests, see `create_app`
+    request.max_content_length = current_app.config.get(
+        'PRODUCT_IMPORT_MAX_SIZE', 32 * 1024 * 1024)
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    if request.args.get('format') == 'csv' or request.mimetype == 'text/csv':
+        records = _csv_records(stream)
+    else:
+        records = _ndjson_records(stream)
+    imported, errors, failure = Product.bulk_import(
+        records, current_user.company_id,
+        current_app.config.get('PRODUCT_IMPORT_CHUNK_SIZE', 1000))
+    result = {'imported': imported,
+              'errors': [{'line': line, 'error': error}
+                         for line, error in errors]}
+    if failure is None:
+        return send_response(200, result)
+    if isinstance(failure, UnicodeDecodeError):
+        return send_response(400, result, 'The file is not UTF-8 encoded text')
+    if isinstance(failure, RequestEntityTooLarge):
+        return send_response(413, result, 'The file is too large')
+    log_activity('EXCEPTION[import_products]', current_user.username,
+                 current_user.company_id, str(failure))
+    return send_response(422, result, 'Unable to add the other products')
+
+
+def _csv_records(stream):
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _ndjson_records(stream):
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, current_app.json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+
 @api.route('/products/', methods=['DELETE'])
 @permission_required(UserType.Administrator)
 @fully_subscribed
@@ -0,0 +1,56 @@
+from datetime import timedelta, date
+
+from flask import request, jsonify
+from flask_login import current_user
+
+from . import v1_api as api
+from .. import db
+from ..decorators import permission_required, UserType, fully_subscribed
+from ..models import DailySale, Product
+from ..utils import send_response, date_from_string
+
+
+@api.route('/reports/sales', methods=['GET'])
+@permission_required(UserType.Administrator)
+@fully_subscribed
+def sales_report():
+    """Quantity and revenue sold between `from` and `to` (both included,
+    default: the last 30 days), optionally broken down by `group_by` day,
+    product or payment_type. Answered from the daily_sales rollup."""
+    date_to = date_from_string(request.args.get('to'), date.today())
+    date_from = date_from_string(request.args.get('from'),
+                                 date_to - timedelta(days=30))
+    group_by = request.args.get('group_by')
+    groups = {'day': (DailySale.day, ),
+              'product': (DailySale.product_id, Product.name),
+              'payment_type': (DailySale.payment_type, )}
+    if group_by is not None and group_by not in groups:
+        return send_response(400, 'Unsupported report grouping')
+
+    quantity = db.func.coalesce(db.func.sum(DailySale.quantity), 0)
+    revenue = db.func.coalesce(db.func.sum(DailySale.revenue), 0.0)
+    query = db.session.query(quantity, revenue).select_from(DailySale).filter(
+        DailySale.company_id == current_user.company_id,
+        DailySale.day >= date_from, DailySale.day <= date_to)
+    total_quantity, total_revenue = query.one()
+    result = {'from': date_from.isoformat(), 'to': date_to.isoformat(),
+              'quantity': total_quantity, 'revenue': total_revenue}
+
+    if group_by is not None:
+        columns = groups[group_by]
+        query = query.add_columns(*columns).group_by(*columns)\
+            .order_by(columns[0])
+        if group_by == 'product':
+            query = query.join(Product, Product.id == DailySale.product_id)
+        breakdown = []
+        for row in query:
+            entry = {'quantity': row[0], 'revenue': row[1]}
+            if group_by == 'day':
+                entry['day'] = row[2].isoformat()
+            elif group_by == 'product':
+                entry['product_id'], entry['product'] = row[2], row[3]
+            else:
+                entry['payment_type'] = row[2]
+            breakdown.append(entry)
+        result['breakdown'] = breakdown
+    return jsonify(result)
@@ -5,7 +5,7 @@ from flask_login import current_user
 
 from . import v1_api
 from ..decorators import paginate, UserType, permission_required, \
-    fully_subscribed
+    fully_subscribed, versioned_etag
 from ..models import db, User
 from ..utils import is_all_type, find_occurrences, log_activity, send_response
 
@@ -71,7 +71,7 @@ def reset_password():
     if user is None:
         return send_response(404, 'The user with the information provided does '
                                   'not exist')
-    if user == current_user:
+    if user.id == current_user.id:
         return send_response(403,
                              'You\'re not allowed to reset your own password\'s '
                              'while logged in')
@@ -104,7 +104,7 @@ def delete_user():
     if not current_user.verify_password(admin_password):
         return send_response(401, 'Password is incorrect')
     user = User.query.filter_by(personal_email=email, company_id=company_id).first()
-    if user is None or user == current_user:
+    if user is None or user.id == current_user.id:
         return send_response(404, 'The user with the information provided does '
                                   'not exist')
     user.deleted = True
@@ -139,7 +139,8 @@ def change_user_role():
 
 @v1_api.route('/list_users', methods=['GET'])
 @permission_required(UserType.Administrator)
-@paginate("users")
 @fully_subscribed
+@versioned_etag(User.__tablename__)
+@paginate("users", count='cached')
 def list_users():
     return User.query.filter(User.company_id == current_user.company_id)
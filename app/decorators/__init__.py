@@ -1,6 +1,6 @@
 from .administrator_required import permission_required, UserType, \
     sudo_required, role_to_string
-from .caching import cache_control, no_cache, etag
+from .caching import cache_control, no_cache, etag, versioned_etag
 from .paginate import paginate
 from .rate_limit import rate_limit
 from .subscribed import fully_subscribed
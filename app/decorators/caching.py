@@ -2,6 +2,10 @@ import functools
 import hashlib
 
 from flask import request, make_response, jsonify
+from flask_login import current_user
+
+from ..cache import resource_versions
+from ..utils import send_response
 
 
 def cache_control(*directives):
@@ -47,6 +51,14 @@ def etag(f):
         if rv.status_code != 200:
             return rv
 
+        # streamed responses would have to be read whole to be hashed
+        if rv.is_streamed:
+            return rv
+
+        # the view already tagged its response, see `versioned_etag`
+        if 'ETag' in rv.headers:
+            return rv
+
         # compute the etag for this request as the MD5 hash of the response
         # text and set it in the response header
         etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
@@ -77,3 +89,42 @@ def etag(f):
                 return response
         return rv
     return wrapped
+
+
+def versioned_etag(*resources):
+    """Entity tags built from the version counters of the resources (table
+    names) the decorated route reads, for the company of the current user.
+
+    The counters are bumped after every commit writing to a resource, so
+    the tag can be computed, and compared with If-None-Match, before the
+    route runs: a client that is up to date gets its 304 for the price of a
+    single cache round trip, without any query or serialization. When the
+    cache is down the route runs as usual."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            if request.method not in ['GET', 'HEAD']:
+                return f(*args, **kwargs)
+            versions = resource_versions(resources, current_user.company_id)
+            if versions is None:
+                return f(*args, **kwargs)
+
+            # the same versions give different responses to other requests
+            # of the route and to other users
+            stamp = '{}|{}|{}|{}'.format(request.endpoint, request.full_path,
+                                         current_user.id, versions)
+            etag = '"v-' + hashlib.md5(stamp.encode('utf-8')).hexdigest() + '"'
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match:
+                etag_list = [tag.strip() for tag in if_none_match.split(',')]
+                if etag in etag_list or '*' in etag_list:
+                    response = send_response(304, 'resource not modified')
+                    response.headers['ETag'] = etag
+                    return response
+
+            rv = make_response(f(*args, **kwargs))
+            if rv.status_code == 200:
+                rv.headers['ETag'] = etag
+            return rv
+        return wrapped
+    return decorator
@@ -1,17 +1,96 @@
+import base64
+import binascii
 import functools
+import hashlib
+import json
+from datetime import date
 
-from flask import url_for, request, jsonify, Response
+from flask import url_for, request, jsonify, Response, abort, current_app
+from flask_login import current_user
+from flask_sqlalchemy import Pagination
 from functools import partial
+from sqlalchemy import tuple_
+
+from ..cache import get_versioned, set_versioned, resource_version_key, \
+    tragel_count_tag
+from ..utils import send_response
 
 url_for = partial(url_for, _scheme='https', _external=True)
 
 
-def paginate(collection, max_per_page=50):
+def encode_cursor(direction, values):
+    """Build the opaque token for a keyset position. `direction` is 'n' for
+    the rows after `values` and 'p' for the rows before them."""
+    data = [direction] + [value.isoformat() if isinstance(value, date)
+                          else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8'))\
+        .decode('utf-8')
+
+
+def decode_cursor(token, keyset):
+    """Return the (direction, values) pair of a token built by
+    `encode_cursor`. Raises ValueError if the token is malformed or one of
+    its values does not have the type of its keyset column."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode('utf-8'))
+                          .decode('utf-8'))
+        direction, values = data[0], data[1:]
+        if direction not in ('n', 'p') or len(values) != len(keyset):
+            raise ValueError('Invalid cursor')
+        return direction, [_cursor_value(column, value)
+                           for column, value in zip(keyset, values)]
+    except (TypeError, KeyError, IndexError, UnicodeError,
+            binascii.Error) as e:
+        raise ValueError(str(e))
+
+
+def _cursor_value(column, value):
+    python_type = column.type.python_type
+    if issubclass(python_type, date):
+        # dates and datetimes are encoded as ISO strings
+        if not isinstance(value, str):
+            raise ValueError('Invalid cursor')
+        return python_type.fromisoformat(value)
+    # JSON has no integer floats, and bool is an int
+    if python_type is float and isinstance(value, int):
+        value = float(value)
+    if isinstance(value, bool) != (python_type is bool) or \
+            not isinstance(value, python_type):
+        raise ValueError('Invalid cursor')
+    return value
+
+
+def paginate(collection, max_per_page=50, serializer=None, columns=None,
+             keyset=None, descending=False, count='exact'):
     """Generate a paginated response for a resource collection.
 
     Routes that use this decorator must return a SQLAlchemy query as a
     response.
 
+    By default every item of the page is converted with its `to_json`
+    method. Resources that can serialize a whole page at once (e.g. with
+    batched queries) pass a `serializer` that takes the list of items of
+    the page and returns the list of dictionaries.
+
+    Read-only listings can also pass the `columns` to select, in which case
+    the page is made of plain result rows instead of ORM objects and the
+    `serializer` must build the dictionaries from those rows.
+
+    Collections that declare a `keyset` (the columns uniquely ordering the
+    collection, e.g. `(Order.date_of_order, Order.id)`) can also be walked
+    with opaque cursors: clients send `cursor` (empty for the first page)
+    instead of `page` and follow `next_cursor`/`prev_cursor`. Each page then
+    costs one indexed range query, whatever its depth, and no count. Rows
+    with a NULL in a keyset column have no position and are left out of
+    the cursor pages; they are only listed by the numbered pages.
+
+    `count` selects how `total` is obtained. 'exact' runs a COUNT for every
+    page. 'cached' keeps the exact count per company and per filter until
+    the company writes to the table. 'estimated' is 'cached', except that
+    sets the database planner estimates above COUNT_ESTIMATE_THRESHOLD rows
+    report that estimate instead of being counted; `total_exact` in the
+    response tells which one the client got.
+
     The output of this decorator is a Python dictionary with the paginated
     results. The application must ensure that this result is converted to a
     response object, either by chaining another decorator or by using a
@@ -22,8 +101,10 @@ def paginate(collection, max_per_page=50):
             # invoke the wrapped function
             query = f(*args, **kwargs)
 
-            if type(query) == Response:
-                return query.json
+            # views may answer with a ready response (e.g. an error), pass
+            # it through instead of decoding and encoding it again
+            if isinstance(query, Response):
+                return query
 
             # obtain pagination arguments from the URL's query string
             page = request.args.get('page', 1, type=int)
@@ -33,12 +114,32 @@ def paginate(collection, max_per_page=50):
             if request.args.get('expanded', 1, type=int) != 0:
                 expanded = 1
 
+            # only select the needed columns, skipping ORM object loading
+            if columns is not None:
+                query = query.with_entities(*columns)
+
+            if keyset is not None and 'cursor' in request.args:
+                return _cursor_page(query, collection, per_page, expanded,
+                                    keyset, descending, serializer, kwargs)
+
             # run the query with Flask-SQLAlchemy's pagination
-            p = query.paginate(page, per_page)
+            if count == 'exact':
+                p = query.paginate(page, per_page)
+                exact = True
+            else:
+                if page < 1:
+                    abort(404)
+                items = query.limit(per_page).offset((page - 1) * per_page)\
+                    .all()
+                if not items and page != 1:
+                    abort(404)
+                total, exact = _total(query, count == 'estimated')
+                p = Pagination(query, page, per_page, total, items)
 
             # build the pagination metadata to include in the response
             pages = {'page': page, 'per_page': per_page,
-                     'total': p.total, 'pages': p.pages}
+                     'total': p.total, 'pages': p.pages,
+                     'total_exact': exact}
             if p.has_prev:
                 pages['prev_url'] = url_for(request.endpoint, page=p.prev_num,
                                             per_page=per_page,
@@ -61,9 +162,120 @@ def paginate(collection, max_per_page=50):
                                         _external=True, **kwargs)
 
             # generate the paginated collection as a dictionary
-            results = [item.to_json() for item in p.items]
+            results = _serialize(p.items, serializer)
 
             # return a dictionary as a response
             return jsonify({collection: results, 'pages': pages})
         return wrapped
     return decorator
+
+
+def _total(query, allow_estimate):
+    """Return a (total, exact) pair for `query`, counting it only when the
+    count cached for the current company and filter is out of date."""
+    query = query.order_by(None)
+    model = query.column_descriptions[0]['entity']
+    company_id = None
+    if hasattr(model, 'company_id'):
+        company_id = getattr(current_user, 'company_id', None)
+    statement = query.statement.compile()
+    digest = hashlib.md5((str(statement) + repr(sorted(
+        statement.params.items()))).encode('utf-8')).hexdigest()
+    cache_key = '{}:{}:{}'.format(tragel_count_tag, resource_version_key(
+        model.__tablename__, company_id), digest)
+
+    # the cached count is only valid for the version it was computed at
+    version, cached = get_versioned(cache_key, model.__tablename__,
+                                    company_id)
+    if cached is not None:
+        return int(cached), True
+
+    if allow_estimate:
+        estimate = _estimate_total(query)
+        threshold = current_app.config.get('COUNT_ESTIMATE_THRESHOLD', 100000)
+        if estimate is not None and estimate >= threshold:
+            return estimate, False
+
+    total = query.count()
+    set_versioned(cache_key, version, total,
+                  current_app.config.get('COUNT_CACHE_TTL', 600))
+    return total, True
+
+
+def _estimate_total(query):
+    """Row estimate of the database planner for `query`, or None if the
+    database cannot give one."""
+    connection = query.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return None
+    statement = query.statement.compile(dialect=connection.dialect)
+    plan = connection.execute('EXPLAIN (FORMAT JSON) ' + str(statement),
+                              statement.params).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def _serialize(items, serializer):
+    if serializer is not None:
+        return serializer(items)
+    return [item.to_json() for item in items]
+
+
+def _cursor_page(query, collection, per_page, expanded, keyset, descending,
+                 serializer, view_args):
+    """Keyset pagination used by `paginate` when a cursor is requested."""
+    token = request.args.get('cursor', '')
+    direction, values = 'n', None
+    if token:
+        try:
+            direction, values = decode_cursor(token, keyset)
+        except ValueError:
+            return send_response(400, 'Invalid cursor')
+
+    # a NULL compares to nothing, such rows cannot be reached by a cursor
+    query = query.filter(*[column.isnot(None) for column in keyset
+                           if column.nullable])
+
+    # walking backwards is walking forwards in the reversed order
+    forward = direction == 'n'
+    ascending = forward != descending
+    query = query.order_by(None).order_by(
+        *[column.asc() if ascending else column.desc() for column in keyset])
+    if values is not None:
+        position = tuple_(*keyset) if len(keyset) > 1 else keyset[0]
+        bound = tuple_(*values) if len(keyset) > 1 else values[0]
+        query = query.filter(position > bound if ascending
+                             else position < bound)
+
+    # fetch one extra row to know whether there is more in that direction
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if not forward:
+        items.reverse()
+
+    def key_of(item):
+        return [getattr(item, column.key) for column in keyset]
+
+    next_cursor, prev_cursor = None, None
+    if items:
+        if has_more or not forward:
+            next_cursor = encode_cursor('n', key_of(items[-1]))
+        if values is not None and (has_more or forward):
+            prev_cursor = encode_cursor('p', key_of(items[0]))
+
+    # keep the filters of the request in the links
+    args = {key: value for key, value in request.args.items()
+            if key not in ('cursor', 'page', 'per_page', 'expanded')}
+    args.update(view_args)
+
+    def link(cursor):
+        if cursor is None:
+            return None
+        return url_for(request.endpoint, cursor=cursor, per_page=per_page,
+                       expanded=expanded, _external=True, **args)
+
+    pages = {'per_page': per_page, 'next_cursor': next_cursor,
+             'prev_cursor': prev_cursor, 'next_url': link(next_cursor),
+             'prev_url': link(prev_cursor), 'first_url': link('')}
+    return jsonify({collection: _serialize(items, serializer),
+                    'pages': pages})
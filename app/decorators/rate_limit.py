@@ -1,7 +1,18 @@
+import fcntl
 import functools
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import uuid
 from time import time
 
 from flask import current_app, request, g, jsonify
+from flask_login import current_user
+
+from .. import cache
 
 _limiter = None
 
@@ -39,11 +50,145 @@ class MemRateLimit(object):
                 del self.counters[key]
 
 
+class RedisRateLimit(object):
+    """Sliding window rate limiter that keeps the hits of every key in a
+    Redis sorted set, so that the limit is shared by all the workers. A
+    check is a single script call. When Redis is unavailable, the checks
+    fall back to a per-process MemRateLimit."""
+    script = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('zremrangebyscore', KEYS[1], '-inf', now - window)
+local hits = redis.call('zcard', KEYS[1])
+local allowed = 0
+if hits < limit then
+    redis.call('zadd', KEYS[1], now, ARGV[4])
+    hits = hits + 1
+    allowed = 1
+end
+redis.call('pexpire', KEYS[1], window)
+local oldest = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+return {allowed, limit - hits, tonumber(oldest[2]) + window}
+"""
+
+    def __init__(self):
+        self.fallback = MemRateLimit()
+        self._script = None
+
+    def _check(self, client, key, limit, period, now):
+        if self._script is None:
+            self._script = client.register_script(self.script)
+        return self._script(keys=['tragel:rate:' + key], args=[
+            now, period * 1000, limit, '{}-{}'.format(now, uuid.uuid4().hex)],
+            client=client)
+
+    def is_allowed(self, key, limit, period):
+        """Same as MemRateLimit.is_allowed, except that the period is a
+        window sliding with each request: a hit stops counting `period`
+        seconds after it was made, and the reset time is when the oldest
+        hit of the window expires."""
+        now = int(time() * 1000)
+        result = cache.run(lambda client: self._check(client, key, limit,
+                                                      period, now))
+        if result is None:
+            return self.fallback.is_allowed(key, limit, period)
+        allowed, remaining, reset = result
+        return allowed == 1, remaining, -(-reset // 1000)
+
+
+class SharedMemRateLimit(object):
+    """Rate limiter for hosts without Redis, with the same fixed periods as
+    MemRateLimit but counters shared by every worker of the host.
+
+    The counters live in a fixed-size table of a memory mapped file: a slot
+    holds the hash of a key, the time its counter resets and its hits.
+    Slots are grouped in stripes; a key always lives in the stripe its hash
+    points to and each stripe has its own file lock, so a check looks at
+    one stripe only. A slot whose counter has reset is free again, hence
+    nothing ever has to be cleaned up; if a stripe is full, the slot that
+    resets first is taken over."""
+    slot = struct.Struct('<QII')
+    stripe_size = 64
+
+    def __init__(self, path, slots):
+        self.stripes = max(1, slots // self.stripe_size)
+        size = self.stripes * self.stripe_size * self.slot.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.table = mmap.mmap(self.fd, size)
+        # file locks are held by the process, threads need their own lock
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        default_path = os.path.join('/dev/shm' if os.path.isdir('/dev/shm')
+                                    else tempfile.gettempdir(),
+                                    'tragel-rate-limit')
+        return cls(current_app.config.get('RATE_LIMIT_SHM_PATH', default_path),
+                   current_app.config.get('RATE_LIMIT_SHM_SLOTS', 65536))
+
+    def is_allowed(self, key, limit, period):
+        """Same as MemRateLimit.is_allowed."""
+        now = int(time())
+        end_period = now // period * period + period
+        digest = int.from_bytes(hashlib.blake2b(
+            key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+        stripe_start = digest % self.stripes * self.stripe_size
+        stripe_length = self.stripe_size * self.slot.size
+        home = digest // self.stripes % self.stripe_size
+
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, stripe_length,
+                        stripe_start * self.slot.size)
+            try:
+                position, free, oldest = None, None, None
+                for i in range(self.stripe_size):
+                    index = stripe_start + (home + i) % self.stripe_size
+                    offset = index * self.slot.size
+                    slot_key, reset, hits = self.slot.unpack_from(self.table,
+                                                                  offset)
+                    if slot_key == digest:
+                        position = offset
+                        break
+                    if slot_key == 0 or reset < now:
+                        if free is None:
+                            free = offset
+                    elif oldest is None or reset < oldest[1]:
+                        oldest = (offset, reset)
+                if position is None or reset < now:
+                    if position is None:
+                        position = free if free is not None else oldest[0]
+                    reset, hits = end_period, 0
+                hits += 1
+                self.slot.pack_into(self.table, position, digest, reset, hits)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, stripe_length,
+                            stripe_start * self.slot.size)
+
+        allow = True
+        remaining = limit - hits
+        if remaining < 0:
+            remaining = 0
+            allow = False
+        return allow, remaining, reset
+
+
+_backends = {'memory': MemRateLimit, 'redis': RedisRateLimit,
+             'shared': SharedMemRateLimit.from_config}
+
+
 def rate_limit(limit, period):
     """Limits the rate at which clients can send requests to 'limit' requests
     per 'period' seconds. Once a client goes over the limit all requests are
     answered with a status code 429 Too Many Requests for the remaining of
-    that period."""
+    that period.
+
+    The counters are kept by the backend named by the RATE_LIMIT_BACKEND
+    configuration: 'memory' (the default, counters of each process),
+    'redis' (counters shared by every worker) or 'shared' (counters shared
+    by the workers of the host, in shared memory)."""
     def decorator(f):
         @functools.wraps(f)
         def wrapped(*args, **kwargs):
@@ -54,12 +199,20 @@ def rate_limit(limit, period):
                 # initialize the rate limiter the first time here
                 global _limiter
                 if _limiter is None:
-                    _limiter = MemRateLimit()
+                    _limiter = _backends[current_app.config.get(
+                        'RATE_LIMIT_BACKEND', 'memory')]()
 
-                # generate a unique key to represent the decorated function and
-                # the IP address of the client. Rate limiting counters are
+                # generate a unique key to represent the decorated function
+                # (qualified by its blueprint, as every blueprint names its
+                # handler `before_request`) and the client: the user when
+                # logged in, else its IP address. Rate limiting counters are
                 # maintained on each unique key.
-                key = '{0}/{1}'.format(f.__name__, request.remote_addr)
+                if current_user.is_authenticated:
+                    client = 'user:{}'.format(current_user.id)
+                else:
+                    client = 'ip:{}'.format(request.remote_addr)
+                key = '{0}.{1}/{2}'.format(request.blueprint, f.__name__,
+                                           client)
                 allowed, remaining, reset = _limiter.is_allowed(key, limit,
                                                                 period)
 
@@ -11,8 +11,7 @@ def fully_subscribed(function):
         if not current_user:
             return send_response(401, 'Unable to get required permission for '
                                       'this request')
-        if current_user.company is None or \
-                not current_user.company.subscription_active:
+        if not current_user.company_subscribed:
             return send_response(401, 'You do not have any active subscription')
         return function(*args, **kwargs)
     return decorated_function
@@ -0,0 +1,101 @@
+import threading
+
+from flask import current_app
+
+_index = None
+_lock = threading.Lock()
+
+
+class GeographyIndex(object):
+    """Read-only view of the countries, states and cities, with the
+    responses of the location endpoints already encoded.
+
+    The data comes from `misc/nigeria.json` and practically never changes,
+    so it is loaded once per process by `get_geography` and looked up from
+    memory afterwards."""
+
+    def __init__(self, countries, states, cities, dumps):
+        # countries: [(id, name)], states: [(id, name, country_id)] and
+        # cities: [(id, name, state_id)], all ordered by id
+        self._countries = {id_: name for id_, name in countries}
+        self._states = {id_: (name, country_id)
+                        for id_, name, country_id in states}
+        self._cities = {id_: (name, state_id) for id_, name, state_id in cities}
+        self._city_ids = {(self._states[state_id][0], name): id_
+                          for id_, name, state_id in cities
+                          if state_id in self._states}
+
+        self.country_choices = tuple(countries)
+        self.state_choices = tuple((id_, name) for id_, name, _ in states)
+        self.city_choices = tuple((id_, name) for id_, name, _ in cities)
+
+        states_of, cities_of = {}, {}
+        for id_, name, country_id in states:
+            states_of.setdefault(country_id, []).append((id_, name))
+        for id_, name, state_id in cities:
+            cities_of.setdefault(state_id, []).append((id_, name))
+        self.countries_json = dumps(list(countries))
+        self._states_json = {country_id: dumps(choices)
+                             for country_id, choices in states_of.items()}
+        self._cities_json = {state_id: dumps(choices)
+                             for state_id, choices in cities_of.items()}
+
+    def location(self, city_id):
+        """(city name, country name) of a city, or ('', '') if unknown."""
+        city = self._cities.get(city_id)
+        state = self._states.get(city[1]) if city else None
+        if state is None:
+            return '', ''
+        return city[0], self._countries.get(state[1], '')
+
+    def city_id(self, state_name, city_name):
+        return self._city_ids.get((state_name, city_name))
+
+    def states_json(self, country_id):
+        """Encoded [[id, name], ...] of the states of a country, or None if
+        the country is unknown."""
+        if country_id not in self._countries:
+            return None
+        return self._states_json.get(country_id, '[]')
+
+    def cities_json(self, state_id):
+        if state_id not in self._states:
+            return None
+        return self._cities_json.get(state_id, '[]')
+
+
+def get_geography():
+    """Return the geography index, loading it on first use."""
+    global _index
+    if _index is None:
+        with _lock:
+            if _index is None:
+                index = _load()
+                # the location tables may not have been filled yet
+                if not index.country_choices:
+                    return index
+                _index = index
+    return _index
+
+
+def reset_geography():
+    """Drop the index so that the next `get_geography` reloads it, e.g. once
+    the location tables have been filled."""
+    global _index
+    _index = None
+
+
+def _load():
+    # imported here, the models module itself resolves locations from
+    # this index
+    from .models import Country, State, City, db
+    countries = db.session.query(Country.id, Country.name)\
+        .order_by(Country.id).all()
+    states = db.session.query(State.id, State.name, State.country_id)\
+        .order_by(State.id).all()
+    cities = db.session.query(City.id, City.name, City.state_id)\
+        .order_by(City.id).all()
+    return GeographyIndex([tuple(row) for row in countries],
+                          [tuple(row) for row in states],
+                          [tuple(row) for row in cities],
+                          current_app.json.dumps)
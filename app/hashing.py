@@ -0,0 +1,147 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+_pool = None
+_lock = threading.Lock()
+_methods = {}
+
+
+class HashingPool(object):
+    """Bounded pool of OS threads running the password hashes.
+
+    PBKDF2 holds the CPU for tens of milliseconds, which under the gevent
+    and eventlet workers blocks every other request of the process. The
+    hash runs on a real thread instead, and the caller waits for it
+    cooperatively: on the hub's thread pool under gevent, on eventlet's
+    tpool under eventlet, or on a ThreadPoolExecutor otherwise. hashlib
+    releases the GIL while hashing, so the threads hash in parallel.
+
+    Requests beyond `workers` wait in the pool's queue. The counters are
+    only updated by the callers, never by the worker threads."""
+
+    def __init__(self, workers, mode='auto'):
+        self.workers = workers
+        self.mode = _cooperative_mode() if mode == 'auto' else mode
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self._counter_lock = threading.Lock()
+        self._submit = getattr(self, '_submit_' + self.mode)
+        if self.mode == 'gevent':
+            from gevent.threadpool import ThreadPool
+            self._executor = ThreadPool(workers)
+        elif self.mode == 'eventlet':
+            from eventlet import tpool
+            tpool.set_num_threads(workers)
+        elif self.mode == 'thread':
+            self._executor = ThreadPoolExecutor(
+                workers, thread_name_prefix='password-hashing')
+
+    def run(self, function, *args):
+        """Call `function(*args)` on the pool and return its result."""
+        with self._counter_lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return self._submit(function, args)
+        finally:
+            with self._counter_lock:
+                self.in_flight -= 1
+                self.completed += 1
+
+    def _submit_gevent(self, function, args):
+        return self._executor.spawn(function, *args).get()
+
+    def _submit_eventlet(self, function, args):
+        from eventlet import tpool
+        return tpool.execute(function, *args)
+
+    def _submit_thread(self, function, args):
+        return self._executor.submit(function, *args).result()
+
+    @staticmethod
+    def _submit_inline(function, args):
+        return function(*args)
+
+    def stats(self):
+        # the pool runs the oldest requests first, so only the ones beyond
+        # the number of workers are waiting
+        in_flight = self.in_flight
+        return {'mode': self.mode, 'workers': self.workers,
+                'running': min(in_flight, self.workers),
+                'queued': max(in_flight - self.workers, 0),
+                'max_in_flight': self.max_in_flight,
+                'completed': self.completed}
+
+
+def _cooperative_mode():
+    """The library that patched the standard library, if any."""
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            return 'gevent'
+    if 'eventlet' in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('thread'):
+            return 'eventlet'
+    return 'thread'
+
+
+def get_pool():
+    """Return the hashing pool of the process, creating it on first use from
+    the PASSWORD_HASH_* configuration."""
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = HashingPool(
+                    current_app.config.get('PASSWORD_HASH_WORKERS',
+                                           os.cpu_count() or 2),
+                    current_app.config.get('PASSWORD_HASH_POOL', 'auto'))
+    return _pool
+
+
+def hash_parameters():
+    """(method, salt length) of new hashes, from PASSWORD_HASH_METHOD and
+    PASSWORD_SALT_LENGTH, e.g. ('pbkdf2:sha256:600000', 16) or
+    ('scrypt:32768:8:1', 16)."""
+    return (current_app.config.get('PASSWORD_HASH_METHOD', 'scrypt'),
+            current_app.config.get('PASSWORD_SALT_LENGTH', 16))
+
+
+def hash_password(password):
+    method, salt_length = hash_parameters()
+    return get_pool().run(generate_password_hash, password, method,
+                          salt_length)
+
+
+def check_password(password_hash, password):
+    return get_pool().run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """True if a stored hash was made with other parameters than the
+    configured ones."""
+    method, salt_length = hash_parameters()
+    parts = password_hash.split('$')
+    return len(parts) != 3 or len(parts[1]) != salt_length or \
+        parts[0] != _full_method(method)
+
+
+def _full_method(method):
+    # Werkzeug fills in the parameters left out of `method` ('scrypt' is
+    # stored as 'scrypt:32768:8:1'), so hash once to learn what it stores
+    full_method = _methods.get(method)
+    if full_method is None:
+        full_method = _methods[method] = get_pool().run(
+            generate_password_hash, '', method, 1).split('$', 1)[0]
+    return full_method
+
+
+def hashing_stats():
+    return get_pool().stats()
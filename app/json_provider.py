@@ -0,0 +1,54 @@
+from datetime import date
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider used by `jsonify` and every response of the app.
+
+    Dates and datetimes are written in ISO 8601 format. When orjson is
+    installed it does the encoding and the response body is built from
+    its output bytes directly, otherwise the standard library is used.
+    Output is only indented when the app runs in debug mode."""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+    def _orjson_option(self, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def _pretty(self):
+        return (self.compact is None and self._app.debug) or \
+            self.compact is False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=self.default,
+                                option=self._orjson_option()).decode('utf-8')
+        return super(FastJSONProvider, self).dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super(FastJSONProvider, self).loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super(FastJSONProvider, self).response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        data = orjson.dumps(obj, default=self.default,
+                            option=self._orjson_option(self._pretty()))
+        return self._app.response_class(data + b'\n', mimetype=self.mimetype)
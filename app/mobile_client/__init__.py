@@ -1,5 +1,5 @@
 from flask import Blueprint
-from flask_httpauth import HTTPBasicAuth
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 
 from ..models import User
 from ..utils import send_response
@@ -7,18 +7,35 @@ from ..utils import send_response
 mobile_api = Blueprint('mobile', __name__)
 
 
-mobile_auth = HTTPBasicAuth()
+# clients send the access token given by /mobile/login as a bearer token;
+# basic authentication is still accepted for older clients, at the cost of
+# a password check on every request
+token_auth = HTTPTokenAuth('Bearer')
+basic_auth = HTTPBasicAuth()
+mobile_auth = MultiAuth(token_auth, basic_auth)
 
 
-@mobile_auth.verify_password
+@token_auth.verify_token
+def verify_token(token):
+    return User.verify_token(token) is not None
+
+
+@basic_auth.verify_password
 def verify_password(username, password):
     user = User.query.filter_by(username=username).first()
     return user is not None and user.verify_password(password)
 
 
-@mobile_auth.error_handler
+# each scheme has its own handler, so that the challenge sent back with the
+# 401 (WWW-Authenticate) names the scheme the client tried
+@token_auth.error_handler
 def unauthorized_token():
     return send_response(401, 'Please send a valid authentication data')
 
 
+@basic_auth.error_handler
+def unauthorized_password():
+    return send_response(401, 'Please send a valid authentication data')
+
+
 from . import views
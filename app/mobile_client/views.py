@@ -1,11 +1,11 @@
-import json
-
-from flask import request
+from flask import request, current_app
 
 from . import mobile_auth, mobile_api
-from ..models import State, City, Company, Product, User, db
-from ..utils import data_cache, tragel_companies_tag, send_response, \
-    log_activity
+from ..geography import get_geography
+from ..models import Company, Product, User, db
+from ..cache import cached_companies_in_city, cache_companies_in_city, \
+    get_versioned, set_versioned, tragel_catalog_tag
+from ..utils import send_response, log_activity, send_encoded_response
 from ..auth import UserType
 
 
@@ -14,25 +14,51 @@ from ..auth import UserType
 def get_companies_in_city():
     state = request.args.get('state', '')
     city = request.args.get('city', '')
-    query = city + '~' + state
-    company_objects = data_cache.hget(tragel_companies_tag, query)
-    if company_objects:
-        return send_response(200, json.loads(company_objects.decode('utf-8')))
-    db_query = db.session.query(Company).join(City).join(State).filter(
-        State.name == state, City.name == city).filter(
-        State.id == City.state_id).filter(Company.city_id == City.id)
-    companies = [company.to_json(with_isoformat=True) for company in
-                 db_query.all()]
-    data_cache.hset(tragel_companies_tag, query, json.dumps(companies))
-    return send_response(200, companies)
+    city_id = get_geography().city_id(state, city)
+    if city_id is None:
+        return send_response(200, [])
+    generation, entries = cached_companies_in_city(city_id)
+    if entries is None:
+        companies = Company.to_json_list(Company.query.filter_by(
+            city_id=city_id).order_by(Company.id), with_isoformat=True)
+        encoded = [(company['id'], current_app.json.dumps(company))
+                   for company in companies]
+        cache_companies_in_city(city_id, generation, encoded)
+        entries = [entry for _, entry in encoded]
+    return send_encoded_response(200, '[' + ','.join(entries) + ']')
 
 
 @mobile_api.route('/get_products/<int:company_id>', methods=['GET'])
 @mobile_auth.login_required
 def get_company_products(company_id):
-    products = [product.to_json() for product in Product.query.filter_by(
-        company_id=company_id).order_by(Product.name).all()]
-    return send_response(200, products)
+    """The catalog of a company, cached as the encoded response body along
+    with the version of the company's products it was built from. Any
+    product write bumps that version, and clients holding the current one
+    get a 304 from a single cache round trip."""
+    catalog_key = '{}:{}'.format(tragel_catalog_tag, company_id)
+    version, body = get_versioned(catalog_key, Product.__tablename__,
+                                  company_id)
+    # without a version (the cache is down) the catalog is read every time
+    etag = None
+    if version is not None:
+        etag = '"catalog-{}-{}"'.format(company_id, version)
+        if_none_match = request.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            response = send_response(304, 'resource not modified')
+            response.headers['ETag'] = etag
+            return response
+
+    if body is None:
+        products = Product.rows_to_json(Product.query.filter_by(
+            company_id=company_id).order_by(Product.name).with_entities(
+            *Product.json_columns()))
+        body = current_app.json.dumps({'status': 200, 'message': products})
+        set_versioned(catalog_key, version, body,
+                      current_app.config.get('CATALOG_CACHE_TTL', 86400))
+    response = current_app.response_class(body, mimetype='application/json')
+    if etag is not None:
+        response.headers['ETag'] = etag
+    return response
 
 
 @mobile_api.route('/login', methods=['POST'])
@@ -51,7 +77,28 @@ def confirm_login():
         log_activity('LOGIN[login_route]', by_=username, for_=username,
                      why_=str(e))
         return send_response(402, 'You tried to login with a bad credential')
-    return send_response(200, 'OK')
+    return send_response(200, {
+        'access_token': User.generate_token(user.id, user.token_generation),
+        'refresh_token': User.generate_token(user.id, user.token_generation,
+                                             refresh=True),
+        'expires_in': current_app.config.get('MOBILE_ACCESS_TOKEN_EXPIRY', 900)
+    })
+
+
+@mobile_api.route('/refresh', methods=['POST'])
+def refresh_token():
+    json_data = request.get_json()
+    identity = None
+    if json_data is not None:
+        identity = User.verify_token(json_data.get('refresh_token', ''),
+                                     refresh=True)
+    if identity is None:
+        return send_response(401, 'Please send a valid refresh token')
+    return send_response(200, {
+        'access_token': User.generate_token(
+            identity['id'], identity.get('token_generation', 0)),
+        'expires_in': current_app.config.get('MOBILE_ACCESS_TOKEN_EXPIRY', 900)
+    })
 
 
 @mobile_api.route('/sign_up', methods=['POST'])
@@ -1,13 +1,26 @@
-from datetime import datetime
+import hashlib
+import math
+from datetime import date, datetime
+from itertools import chain
+from time import time
 
 from flask import current_app
 from flask_login import UserMixin, AnonymousUserMixin, LoginManager
-from flask_sqlalchemy import SQLAlchemy, BaseQuery
+from flask_sqlalchemy import SQLAlchemy, BaseQuery, SignallingSession
 from itsdangerous import JSONWebSignatureSerializer as JSONSerializer, \
-    base64_decode, base64_encode
-from werkzeug.security import generate_password_hash, check_password_hash
+    TimedJSONWebSignatureSerializer as TimedJSONSerializer, base64_decode, \
+    base64_encode
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import set_committed_value
 
 from .decorators import role_to_string
+from .cache import bump_resource_versions, invalidate_companies_in_cities, \
+    cached_identity, cache_identity, invalidate_identities
+from .geography import get_geography
+from .hashing import hash_password, check_password, needs_rehash
 from .utils import log_activity, https_url_for, PaymentType, \
     generate_payment_id
 
@@ -26,7 +39,9 @@ class Company(db.Model):
     address = db.Column(db.String(256), nullable=False)
     city_id = db.Column(db.Integer, db.ForeignKey('cities.id'), nullable=False)
     date_of_creation = db.Column(db.DateTime, nullable=False, default=datetime.now)
-    subscription_active = db.Column(db.Boolean(), default=False, nullable=False)
+    # end date of the latest subscription, set whenever one is added; NULL
+    # until `backfill_active_until` ran for the companies subscribed before
+    active_until = db.Column(db.Date, nullable=True)
     staffs = db.relationship('User', backref='company')
     orders = db.relationship('Order', backref='company')
     subscriptions = db.relationship('Subscription', backref='company',
@@ -42,18 +57,83 @@ class Company(db.Model):
         s = JSONSerializer(current_app.config['SECRET_KEY'])
         return s.dumps({'id': self.id}).decode('utf-8')
 
+    def add_subscription(self, subscription):
+        self.subscriptions.append(subscription)
+        self.active_until = subscription.end_date
+
+    def subscription_end(self):
+        """`active_until`, or the end date of the latest subscription when
+        it is not set."""
+        if self.active_until is not None:
+            return self.active_until
+        return db.session.query(Subscription.end_date)\
+            .filter(Subscription.company_id == self.id)\
+            .order_by(Subscription.id.desc()).limit(1).scalar()
+
+    @staticmethod
+    def backfill_active_until(chunk_size=10000):
+        """Set the `active_until` date of every company from its latest
+        subscription. Returns the number of companies updated."""
+        companies = Company.__table__
+        latest = db.select([Subscription.end_date])\
+            .where(Subscription.company_id == companies.c.id)\
+            .order_by(Subscription.id.desc()).limit(1).as_scalar()
+        last_id = db.session.query(db.func.max(Company.id)).scalar() or 0
+        updated = 0
+        for start in range(0, last_id + 1, chunk_size):
+            company_ids = [company_id for company_id, in db.session.execute(
+                db.select([companies.c.id])
+                .where(companies.c.id >= start)
+                .where(companies.c.id < start + chunk_size)
+                .where(companies.c.active_until.is_distinct_from(latest)))]
+            if not company_ids:
+                continue
+            db.session.execute(companies.update()
+                               .where(companies.c.id.in_(company_ids))
+                               .values(active_until=latest))
+            user_ids = [user_id for user_id, in db.session.query(User.id)
+                        .filter(User.company_id.in_(company_ids))]
+            db.session.commit()
+            invalidate_identities(user_ids)
+            updated += len(company_ids)
+        return updated
+
     def to_json(self, with_isoformat=None):
-        city = City.query.filter_by(id=self.city_id).first()
-        country = city.state.country.name if city else ''
-        city = city.name if city else ''
-        response = {'name': self.name, 'id': self.id, 'city': city,
-                    'country': country, 'staffs': len(self.staffs),
-                    'products': len(self.products),
-                    'date': self.date_of_creation.isoformat() if
-                    with_isoformat else self.date_of_creation}
-        if self.headquarter_id is None:
-            response['branches'] = len(self.branches)
-        return response
+        return Company.to_json_list([self], with_isoformat)[0]
+
+    @staticmethod
+    def to_json_list(companies, with_isoformat=None):
+        """Serialize a batch of companies. Staff, product and branch counts
+        come from grouped aggregate queries over the whole batch, so the cost
+        does not grow with the size of a company, and the location names
+        from the in-memory geography index."""
+        companies = list(companies)
+        if not companies:
+            return []
+        company_ids = [company.id for company in companies]
+
+        def count_by(column):
+            return dict(db.session.query(column, db.func.count()).filter(
+                column.in_(company_ids)).group_by(column))
+
+        staffs = count_by(User.company_id)
+        products = count_by(Product.company_id)
+        branches = count_by(Company.headquarter_id)
+        geography = get_geography()
+
+        results = []
+        for company in companies:
+            city, country = geography.location(company.city_id)
+            response = {'name': company.name, 'id': company.id, 'city': city,
+                        'country': country,
+                        'staffs': staffs.get(company.id, 0),
+                        'products': products.get(company.id, 0),
+                        'date': company.date_of_creation.isoformat() if
+                        with_isoformat else company.date_of_creation}
+            if company.headquarter_id is None:
+                response['branches'] = branches.get(company.id, 0)
+            results.append(response)
+        return results
 
     @staticmethod
     def verify_auth_token(token):
@@ -76,6 +156,12 @@ class Company(db.Model):
             return None
 
 
+def is_active_until(active_until):
+    """True if a subscription ending on `active_until` is still running."""
+    return active_until is not None and \
+        active_until >= datetime.utcnow().date()
+
+
 class SoftDeletedQuery(BaseQuery):
     _with_deleted = False
 
@@ -110,11 +196,14 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(64), index=True, unique=True, nullable=False)
     personal_email = db.Column(db.String(128), index=True, unique=True)
     address = db.Column(db.String(128), index=False, nullable=True)
-    password_hash = db.Column(db.String(128), nullable=False, index=True)
+    password_hash = db.Column(db.String(256), nullable=False, index=True)
     company_id = db.Column(db.Integer, db.ForeignKey('companies.id'))
     role = db.Column(db.SmallInteger, nullable=False)
     deleted = db.Column(db.Boolean(), default=False, nullable=False)
     is_confirmed = db.Column(db.Boolean(), default=True, nullable=False)
+    # stored in the mobile tokens, bumped to revoke the ones already issued
+    token_generation = db.Column(db.Integer, default=0, server_default='0',
+                                 nullable=False)
     query_class = SoftDeletedQuery
 
 
@@ -134,13 +223,147 @@ class User(db.Model, UserMixin):
 
     @password.setter
     def password(self, new_password):
-        self.password_hash = generate_password_hash(new_password)
+        self.password_hash = hash_password(new_password)
+        self.revoke_tokens()
+
+    @validates('role')
+    def validate_role(self, key, role):
+        if self.role is not None and role != self.role:
+            self.revoke_tokens()
+        return role
+
+    def revoke_tokens(self):
+        """Invalidate the mobile tokens issued to the user so far."""
+        self.token_generation = (self.token_generation or 0) + 1
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not check_password(self.password_hash, password):
+            return False
+        if needs_rehash(self.password_hash):
+            self.rehash_password(password)
+        return True
+
+    def rehash_password(self, password):
+        """Store the password again with the configured hash parameters.
+        Only the hash is written, and a failure leaves the old one valid."""
+        new_hash = hash_password(password)
+        try:
+            # on a connection of its own, so the caller's session and its
+            # pending changes are left alone
+            with db.engine.begin() as connection:
+                connection.execute(User.__table__.update()
+                                   .where(User.id == self.id)
+                                   .values(password_hash=new_hash))
+        except Exception as e:
+            log_activity('REHASH[rehash_password]', self.username, '', str(e))
+            return
+        set_committed_value(self, 'password_hash', new_hash)
+
+    @property
+    def active_until(self):
+        """Last day of the subscription of the user's company."""
+        return self.company.subscription_end() if self.company is not None \
+            else None
+
+    @property
+    def company_subscribed(self):
+        return is_active_until(self.active_until)
+
+    def identity(self):
+        """The columns of the user needed to authenticate its requests and
+        check their permissions."""
+        active_until = self.active_until
+        return {'id': self.id, 'username': self.username,
+                'fullname': self.fullname, 'role': self.role,
+                'company_id': self.company_id, 'deleted': self.deleted,
+                'token_generation': self.token_generation or 0,
+                'active_until': active_until.isoformat()
+                if active_until is not None else None}
+
+    @staticmethod
+    def generate_token(user_id, token_generation, refresh=False):
+        """Signed access token, or refresh token with `refresh`, valid while
+        the user's `token_generation` is the one given."""
+        if refresh:
+            expiry = current_app.config.get('MOBILE_REFRESH_TOKEN_EXPIRY',
+                                            2592000)
+        else:
+            expiry = current_app.config.get('MOBILE_ACCESS_TOKEN_EXPIRY', 900)
+        s = TimedJSONSerializer(current_app.config['SECRET_KEY'],
+                                expires_in=expiry, salt='mobile-refresh'
+                                if refresh else 'mobile-access')
+        return s.dumps({'id': user_id,
+                        'gen': token_generation}).decode('utf-8')
+
+    @staticmethod
+    def verify_token(token, refresh=False):
+        """Return the `identity` of the user a token was issued to, or None
+        if the token is invalid, expired or revoked, or the user deleted."""
+        s = TimedJSONSerializer(current_app.config['SECRET_KEY'],
+                                salt='mobile-refresh' if refresh
+                                else 'mobile-access')
+        try:
+            payload = s.loads(token)
+        except Exception:
+            return None
+        user_id = payload.get('id') if isinstance(payload, dict) else None
+        identity = User.load_identity(user_id) if user_id is not None \
+            else None
+        if identity is None or identity['deleted'] or \
+                payload.get('gen') != identity.get('token_generation', 0):
+            return None
+        return identity
+
+    @staticmethod
+    def load_identity(user_id):
+        """Return the `identity` of a user, from the cache when possible, or
+        None if there is no such user."""
+        generation, identity = cached_identity(user_id)
+        if identity is None:
+            user = User.query.with_deleted().get(user_id)
+            if user is None:
+                return None
+            identity = user.identity()
+            cache_identity(user_id, generation, identity)
+        return identity
+
+
+class CachedUser(UserMixin):
+    """The logged in user of a session, built from its cached `identity`.
+    Anything but the identity columns loads the User on first use."""
+
+    def __init__(self, identity):
+        self._identity = identity
+        self._user = None
+
+    def __getattr__(self, name):
+        identity = self.__dict__['_identity']
+        if name in identity:
+            return identity[name]
+        return getattr(self._load(), name)
+
+    def _load(self):
+        if self._user is None:
+            self._user = User.query.with_deleted().get(self._identity['id'])
+        return self._user
+
+    @property
+    def active_until(self):
+        if 'active_until' not in self._identity:
+            # cached before the identity had the date
+            return self._load().active_until
+        active_until = self._identity['active_until']
+        return date.fromisoformat(active_until) if active_until else None
+
+    company_subscribed = User.company_subscribed
+
+    def __repr__(self):
+        return '<CachedUser {}, {}>'.format(self.fullname, self.username)
 
 
 class Anonymous(AnonymousUserMixin):
+    company_subscribed = False
+
     @staticmethod
     def verify_password():
         return False
@@ -187,6 +410,80 @@ class Product(db.Model):
             items.append(new_product)
         return items
 
+    @staticmethod
+    def bulk_import(records, company_id, chunk_size=1000):
+        """Insert the valid products of `records`, (row number, dict) pairs in
+        the `from_json` format, committing `chunk_size` at a time. Returns the
+        count inserted, the (row number, error) of the records skipped and the
+        exception that stopped the import, if any."""
+        table = Product.__table__
+        imported, errors, seen = 0, [], set()
+        chunk = []
+
+        def flush():
+            names = [row['name'] for _, row in chunk]
+            taken = {name for name, in db.session.query(Product.name).filter(
+                Product.company_id == company_id, Product.deleted.is_(False),
+                Product.name.in_(names))}
+            rows = []
+            for row_number, row in chunk:
+                if row['name'] in taken:
+                    errors.append((row_number,
+                                   'Product with that name already exist'))
+                else:
+                    rows.append(row)
+            if rows:
+                db.session.execute(table.insert(), rows)
+                mark_changed(Product.__tablename__, company_id)
+                db.session.commit()
+            del chunk[:]
+            return len(rows)
+
+        try:
+            for row_number, json_object in records:
+                try:
+                    row = Product._import_row(json_object, company_id)
+                except (ValueError, TypeError, AttributeError) as e:
+                    errors.append((row_number, str(e) or 'Invalid product'))
+                    continue
+                if row['name'] in seen:
+                    errors.append((row_number, 'Duplicate product name'))
+                    continue
+                seen.add(row['name'])
+                chunk.append((row_number, row))
+                if len(chunk) >= chunk_size:
+                    imported += flush()
+            if chunk:
+                imported += flush()
+        except Exception as e:
+            db.session.rollback()
+            return imported, errors, e
+        return imported, errors, None
+
+    @staticmethod
+    def _import_row(json_object, company_id):
+        if not isinstance(json_object, dict):
+            raise ValueError('Invalid product')
+        price = json_object.get('price')
+        if isinstance(price, bool):
+            raise ValueError('Invalid price')
+        row = {'name': json_object.get('name') or '',
+               'price': float(price or 0.0),
+               'thumbnail': json_object.get('thumbnail') or '',
+               'description': json_object.get('desc') or '',
+               'category': json_object.get('cat') or '',
+               'company_id': company_id, 'deleted': False}
+        if not row['name']:
+            raise ValueError('The product has no name')
+        if not math.isfinite(row['price']):
+            raise ValueError('Invalid price')
+        if row['price'] < 0:
+            raise ValueError('The price cannot be negative')
+        for key in ('name', 'thumbnail', 'description', 'category'):
+            if len(row[key]) > Product.__table__.c[key].type.length:
+                raise ValueError('The {} is too long'.format(key))
+        return row
+
     def __eq__(self, other):
         return self.name == other.name and self.price == other.price and\
             self.thumbnail == other.thumbnail
@@ -199,6 +496,27 @@ class Product(db.Model):
                                                            product_id=self.id),
         }
 
+    @staticmethod
+    def json_columns():
+        """Columns needed to build the JSON of a product without loading the
+        whole ORM object, see `rows_to_json`."""
+        return (Product.id, Product.name, Product.price, Product.deleted,
+                Product.thumbnail, Product.category, Product.description)
+
+    @staticmethod
+    def rows_to_json(rows):
+        """Build the same dictionaries as `to_json` straight from result rows
+        selected with `json_columns`. This is meant for read-only listings:
+        no objects go into the session's identity map."""
+        # one url_for call: the url of product 0, split around its id
+        prefix, suffix = https_url_for('api.get_product',
+                                       product_id=0).rsplit('0', 1)
+        return [{
+            'name': row.name, 'price': row.price, 'deleted': row.deleted,
+            'thumbnail': row.thumbnail, 'id': row.id, 'cat': row.category,
+            'desc': row.description, 'url': prefix + str(row.id) + suffix,
+        } for row in rows]
+
     def __repr__(self):
         return '<Product: Company -> {}, Name -> {}, Price -> {}>'\
             .format(self.company_id, self.name, self.price)
@@ -211,6 +529,9 @@ class Item(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'),
                            index=True)
     quantity = db.Column(db.Integer, default=lambda: 1)
+    # unit price of the product when the order was taken, NULL for the items
+    # of the orders taken before it was stored
+    price = db.Column(db.Float, nullable=True)
 
     def to_json(self):
         product = Product.query.with_deleted().get(self.product_id)
@@ -234,11 +555,22 @@ class Order(db.Model):
     payment_confirmed = db.relationship('Confirmation', backref='order',
                                         uselist=False)
     deleted = db.Column(db.Boolean(), default=False, nullable=False)
+    # generated by the client so that a retried order is only created once
+    idempotency_key = db.Column(db.String(64), nullable=True)
 
     query_class = SoftDeletedQuery
+    __table_args__ = (
+        db.UniqueConstraint('company_id', 'idempotency_key',
+                            name='uq_orders_company_idempotency_key'),
+        db.Index('ix_orders_company_date', 'company_id', 'date_of_order'),
+        db.Index('ix_orders_company_staff_date', 'company_id', 'staff_id',
+                 'date_of_order'),
+        db.Index('ix_orders_company_payment_date', 'company_id',
+                 'payment_type', 'date_of_order'),
+    )
 
     @staticmethod
-    def import_data(order_data):
+    def import_data(order_data, company_id):
         try:
             payment_ref_id = order_data.get('payment_reference_id')
             paid_in_cash = payment_ref_id == 'cash'
@@ -249,22 +581,354 @@ class Order(db.Model):
                 new_item = Item(quantity=item.get('quantity'),
                                 product_id=item.get('product_id'))
                 order_list.append(new_item)
+            prices = dict(db.session.query(Product.id, Product.price).filter(
+                Product.company_id == company_id,
+                Product.id.in_({item.product_id for item in order_list})))
+            if any(item.product_id not in prices for item in order_list):
+                return None
+            for item in order_list:
+                item.price = prices[item.product_id]
             pay_type = PaymentType.Cash if paid_in_cash else PaymentType.EBanking
             return payment_ref_id, pay_type, order_list
         except:
             return None
 
+    @staticmethod
+    def submit_batch(orders, company_id, staff_id, retry=True):
+        """Create the orders of a batch, each in the `import_data` format with
+        a client generated `key`, and return one result per order. An order
+        whose key was already used gets the result of the first one, so a
+        batch can be retried safely."""
+        results = [None] * len(orders)
+        indexes, parsed = {}, {}
+        for index, order in enumerate(orders):
+            key = order.get('key') if isinstance(order, dict) else None
+            if not isinstance(key, str) or not 0 < len(key) <= 64:
+                results[index] = {'key': key,
+                                  'error': 'Invalid idempotency key'}
+                continue
+            # a key repeated in the batch is the same order
+            if key not in indexes:
+                parsed[key] = Order._parse_batch_order(order)
+            indexes.setdefault(key, []).append(index)
+
+        def existing_orders(keys, references=()):
+            """The results of the orders of the company created with `keys`,
+            and the `references` already used by any order, in one query."""
+            conditions = []
+            if keys:
+                conditions.append(db.and_(Order.company_id == company_id,
+                                          Order.idempotency_key.in_(keys)))
+            if references:
+                conditions.append(Order.payment_reference.in_(references))
+            found, used = {}, set()
+            if conditions:
+                for key, order_id, reference, order_company_id in \
+                        db.session.query(Order.idempotency_key, Order.id,
+                                         Order.payment_reference,
+                                         Order.company_id)\
+                        .filter(db.or_(*conditions)):
+                    if order_company_id == company_id and key in keys:
+                        found[key] = {'key': key, 'order_id': order_id,
+                                      'payment_reference': reference}
+                    used.add(reference)
+            return found, used
+
+        done, used = existing_orders(
+            set(indexes), {order[0] for order in parsed.values()
+                           if not isinstance(order, str)})
+        new = {}
+        for key, order in parsed.items():
+            if key in done:
+                continue
+            if isinstance(order, str):
+                done[key] = {'key': key, 'error': order}
+            elif order[0] in used:
+                done[key] = {'key': key,
+                             'error': 'Payment reference already used'}
+            else:
+                used.add(order[0])
+                new[key] = order
+
+        product_ids = {product_id for _, _, items in new.values()
+                       for product_id, _ in items}
+        known = {}
+        if product_ids:
+            known = dict(db.session.query(Product.id, Product.price).filter(
+                Product.company_id == company_id,
+                Product.id.in_(product_ids)))
+        for key, (_, _, items) in list(new.items()):
+            if any(product_id not in known for product_id, _ in items):
+                done[key] = {'key': key, 'error': 'Unknown product'}
+                del new[key]
+
+        if new:
+            now = datetime.now()
+            try:
+                db.session.execute(Order.__table__.insert(), [
+                    {'staff_id': staff_id, 'date_of_order': now,
+                     'payment_type': payment_type,
+                     'payment_reference': payment_reference,
+                     'company_id': company_id, 'deleted': False,
+                     'idempotency_key': key}
+                    for key, (payment_reference, payment_type, _)
+                    in new.items()])
+                created, _ = existing_orders(set(new))
+                db.session.execute(Item.__table__.insert(), [
+                    {'order_id': created[key]['order_id'],
+                     'product_id': product_id, 'quantity': quantity,
+                     'price': known[product_id]}
+                    for key, (_, _, items) in new.items()
+                    for product_id, quantity in items])
+                for payment_type in {order[1] for order in new.values()}:
+                    DailySale.record(company_id, now.date(), payment_type, [
+                        (product_id, quantity, known[product_id])
+                        for _, type_, items in new.values()
+                        if type_ == payment_type
+                        for product_id, quantity in items])
+                mark_changed(Order.__tablename__, company_id)
+                mark_changed(Item.__tablename__, None)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                if not retry:
+                    raise
+                # another request created some of the orders meanwhile, the
+                # second attempt returns them
+                return Order.submit_batch(orders, company_id, staff_id,
+                                          retry=False)
+            done.update(created)
+
+        for key, key_indexes in indexes.items():
+            for index in key_indexes:
+                results[index] = done[key]
+        return results
+
+    @staticmethod
+    def _parse_batch_order(order):
+        """(payment reference, payment type, [(product id, quantity)]) of an
+        order of a batch, or the reason it is invalid."""
+        payment_reference = order.get('payment_reference_id')
+        if not isinstance(payment_reference, str) or not payment_reference:
+            return 'Missing payment reference'
+        items = order.get('items')
+        if not isinstance(items, list) or not items:
+            return 'The order has no items'
+        parsed_items = []
+        for item in items:
+            if not isinstance(item, dict):
+                return 'Invalid item'
+            product_id = item.get('product_id')
+            quantity = item.get('quantity')
+            quantity = 1 if quantity is None else quantity
+            if not isinstance(product_id, int) or \
+                    not isinstance(quantity, int) or quantity < 1:
+                return 'Invalid item'
+            parsed_items.append((product_id, quantity))
+        if payment_reference == 'cash':
+            return generate_payment_id(), PaymentType.Cash, parsed_items
+        return payment_reference, PaymentType.EBanking, parsed_items
+
     def to_json(self):
-        result = {
-            'id': self.id, 'staff': User.query.get(self.staff_id).fullname,
-            'payment_type': self.payment_type,
-            'payment_reference': self.payment_reference,
-            'date': self.date_of_order.isoformat(),
-            'items': [item.to_json() for item in self.items],
-        }
-        if self.payment_confirmed is not None:
-            result['confirmation'] = self.payment_confirmed.to_json()
-        return result
+        return Order.to_json_list([self])[0]
+
+    @staticmethod
+    def to_json_list(orders):
+        """Serialize a page of orders. The staff, items, products and
+        confirmations of the whole page are loaded with a fixed number of
+        queries instead of several queries per order."""
+        orders = list(orders)
+        if not orders:
+            return []
+        order_ids = [order.id for order in orders]
+
+        items = {}
+        for order_id, product_id, quantity in db.session.query(
+                Item.order_id, Item.product_id, Item.quantity).filter(
+                Item.order_id.in_(order_ids)).order_by(Item.id):
+            items.setdefault(order_id, []).append((product_id, quantity))
+        confirmations = {row.order_id: row for row in db.session.query(
+            Confirmation.order_id, Confirmation.confirmed,
+            Confirmation.admin_id, Confirmation.date).filter(
+            Confirmation.order_id.in_(order_ids))}
+
+        product_ids = {product_id for order_items in items.values()
+                       for product_id, _ in order_items}
+        products = {}
+        if product_ids:
+            products = {row.id: row for row in db.session.query(
+                Product.id, Product.name, Product.price).filter(
+                Product.id.in_(product_ids))}
+        user_ids = {order.staff_id for order in orders}
+        user_ids.update(row.admin_id for row in confirmations.values()
+                        if row.confirmed == 1)
+        fullnames = dict(db.session.query(User.id, User.fullname).filter(
+            User.id.in_(user_ids)))
+
+        results = []
+        for order in orders:
+            result = {
+                'id': order.id, 'staff': fullnames[order.staff_id],
+                'payment_type': order.payment_type,
+                'payment_reference': order.payment_reference,
+                'date': order.date_of_order.isoformat(),
+                'items': [{'product': products[product_id].name,
+                           'quantity': quantity,
+                           'price': products[product_id].price}
+                          for product_id, quantity in items.get(order.id, [])],
+            }
+            confirmation = confirmations.get(order.id)
+            if confirmation is not None:
+                result['confirmation'] = {'confirmed': confirmation.confirmed}
+                if confirmation.confirmed == 1:
+                    result['confirmation']['by'] = \
+                        fullnames[confirmation.admin_id]
+                    result['confirmation']['date'] = \
+                        confirmation.date.isoformat()
+            results.append(result)
+        return results
+
+
+class DailySale(db.Model):
+    """Quantity and revenue sold per company, day, product and payment type.
+    The rows are updated in the transaction that records or deletes an
+    order, so that sales reports never have to read the orders."""
+    __tablename__ = 'daily_sales'
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'),
+                           primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'),
+                           primary_key=True)
+    payment_type = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+    @staticmethod
+    def record(company_id, day, payment_type, items, sign=1):
+        """Add the (product_id, quantity, price) triples in `items` to the
+        totals of the day, or subtract them with `sign=-1`."""
+        items = list(items)
+        missing = {product_id for product_id, _, price in items
+                   if price is None}
+        prices = {}
+        if missing:
+            prices = dict(db.session.query(Product.id, Product.price).filter(
+                Product.id.in_(missing)))
+        totals = {}
+        for product_id, quantity, price in items:
+            quantity = 1 if quantity is None else quantity
+            if price is None:
+                price = prices.get(product_id, 0.0)
+            total = totals.setdefault(product_id, [0, 0.0])
+            total[0] += quantity
+            total[1] += quantity * price
+        if not totals:
+            return
+        rows = [{'company_id': company_id, 'day': day,
+                 'product_id': product_id, 'payment_type': payment_type,
+                 'quantity': sign * quantity, 'revenue': sign * revenue}
+                for product_id, (quantity, revenue) in totals.items()]
+
+        table = DailySale.__table__
+        if db.session.get_bind().dialect.name == 'postgresql':
+            statement = postgresql.insert(table).values(rows)
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=[column.name for column in table.primary_key],
+                set_={'quantity': table.c.quantity + statement.excluded.quantity,
+                      'revenue': table.c.revenue + statement.excluded.revenue}))
+        else:
+            for row in rows:
+                result = db.session.execute(table.update().where(db.and_(
+                    table.c.company_id == company_id, table.c.day == day,
+                    table.c.product_id == row['product_id'],
+                    table.c.payment_type == payment_type)).values(
+                    quantity=table.c.quantity + row['quantity'],
+                    revenue=table.c.revenue + row['revenue']))
+                if result.rowcount == 0:
+                    db.session.execute(table.insert().values(**row))
+        mark_changed(DailySale.__tablename__, company_id)
+
+    @staticmethod
+    def backfill(company_id=None):
+        """Rebuild the totals from the orders, for one company or for all of
+        them, with a single INSERT ... SELECT."""
+        table = DailySale.__table__
+        delete = table.delete()
+        if company_id is not None:
+            delete = delete.where(table.c.company_id == company_id)
+        db.session.execute(delete)
+
+        # SQLite casts '2019-05-01 10:00:00' to the integer 2019
+        if db.session.get_bind().dialect.name == 'sqlite':
+            day = db.func.date(Order.date_of_order)
+        else:
+            day = db.cast(Order.date_of_order, db.Date)
+        quantity = db.func.coalesce(Item.quantity, 1)
+        price = db.func.coalesce(Item.price, Product.price)
+        totals = db.select([Order.company_id, day, Item.product_id,
+                            Order.payment_type, db.func.sum(quantity),
+                            db.func.sum(quantity * price)])\
+            .select_from(Order.__table__.join(Item.__table__).join(
+                Product.__table__))\
+            .where(Order.deleted == False)\
+            .group_by(Order.company_id, day, Item.product_id,
+                      Order.payment_type)
+        if company_id is not None:
+            totals = totals.where(Order.company_id == company_id)
+        result = db.session.execute(table.insert().from_select(
+            ['company_id', 'day', 'product_id', 'payment_type', 'quantity',
+             'revenue'], totals))
+        company_ids = [company_id] if company_id is not None else \
+            [row[0] for row in db.session.query(DailySale.company_id)
+                .distinct()]
+        for changed_id in company_ids:
+            mark_changed(DailySale.__tablename__, changed_id)
+        db.session.commit()
+        return result.rowcount
+
+
+class PendingBump(db.Model):
+    """A version bump that could not reach Redis. Any worker applies it
+    once Redis is back, so that it is not lost with the process that made
+    it."""
+    __tablename__ = 'pending_bumps'
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String(64), nullable=False)
+    company_id = db.Column(db.Integer, nullable=True)
+
+    # when this process looks at the table next
+    next_check = 0
+
+    @staticmethod
+    def save(bumps):
+        if not bumps:
+            return
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(PendingBump.__table__.insert(), [
+                    {'resource': resource, 'company_id': company_id}
+                    for resource, company_id in bumps])
+        except Exception as e:
+            log_activity('CACHE[pending_bumps]', '', '', str(e))
+
+    @staticmethod
+    def apply():
+        """Apply the saved bumps, at most once every PENDING_BUMPS_INTERVAL
+        seconds per process."""
+        now = time()
+        if now < PendingBump.next_check:
+            return
+        PendingBump.next_check = now + current_app.config.get(
+            'PENDING_BUMPS_INTERVAL', 5)
+        table = PendingBump.__table__
+        with db.engine.begin() as connection:
+            rows = connection.execute(db.select([
+                table.c.id, table.c.resource, table.c.company_id])).fetchall()
+            if not rows or bump_resource_versions(
+                    {(row.resource, row.company_id) for row in rows}):
+                return
+            connection.execute(table.delete().where(
+                table.c.id.in_([row.id for row in rows])))
 
 
 class Stock(db.Model):
@@ -296,8 +960,14 @@ class Confirmation(db.Model):
 
 class Subscription(db.Model):
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        db.Index('ix_subscriptions_company_latest', 'company_id', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     token = db.Column(db.Text, nullable=False)
+    # sha256 of the token, unique so that a token is only redeemed once
+    token_digest = db.Column(db.String(64), nullable=True, unique=True,
+                             index=True)
     begin_date = db.Column(db.Date, nullable=False)
     end_date = db.Column(db.Date, nullable=False)
     company_id = db.Column(db.Integer, db.ForeignKey('companies.id'))
@@ -306,6 +976,40 @@ class Subscription(db.Model):
         return {'from': self.begin_date.isoformat(), 'to':
             self.end_date.isoformat()}
 
+    @validates('token')
+    def _set_token_digest(self, key, token):
+        self.token_digest = Subscription.digest(token)
+        return token
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_used(token):
+        return db.session.query(Subscription.id).filter_by(
+            token_digest=Subscription.digest(token)).first() is not None
+
+    @staticmethod
+    def backfill_token_digests(chunk_size=1000):
+        """Compute the missing token digests, `chunk_size` subscriptions at
+        a time. Returns the number of subscriptions updated."""
+        table = Subscription.__table__
+        update = table.update().where(table.c.id == db.bindparam('_id'))\
+            .values(token_digest=db.bindparam('_digest'))
+        updated = 0
+        while True:
+            rows = db.session.query(Subscription.id, Subscription.token)\
+                .filter(Subscription.token_digest.is_(None))\
+                .order_by(Subscription.id).limit(chunk_size).all()
+            if not rows:
+                return updated
+            db.session.execute(update, [
+                {'_id': id_, '_digest': Subscription.digest(token)}
+                for id_, token in rows])
+            db.session.commit()
+            updated += len(rows)
+
     # we need these builtin functions in order to use the min-max functions
     # see the decorator implementation: `subscribed`
     def __lt__(self, other):
@@ -376,9 +1080,69 @@ class City(db.Model):
         return self.name
 
 
+def mark_changed(resource, company_id, session=None):
+    """Record a write to `resource` (a table name) for a company, so that its
+    version is bumped when the transaction commits. ORM flushes are
+    recorded automatically, Core statements have to call this."""
+    session = session if session is not None else db.session()
+    session.info.setdefault('changed_resources', set()).add((resource,
+                                                             company_id))
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _record_flushed_changes(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        mark_changed(obj.__tablename__, getattr(obj, 'company_id', None),
+                     session)
+
+    users = session.info.setdefault('changed_users', set())
+    users.update(obj.id for obj in chain(session.dirty, session.deleted)
+                 if isinstance(obj, User))
+    # the identities of the staff hold the subscription of the company
+    companies = [obj.id for obj in session.dirty if isinstance(obj, Company)
+                 and inspect(obj).attrs.active_until.history.has_changes()]
+    if companies:
+        users.update(user_id for user_id, in session.query(User.id)
+                     .filter(User.company_id.in_(companies)))
+
+    # cities whose cached companies changed; new companies are added to the
+    # cache by the views, the others are dropped to be rebuilt
+    cities = session.info.setdefault('changed_cities', {})
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Company):
+            history = inspect(obj).attrs.city_id.history
+            for city_id in chain(history.deleted, [obj.city_id]):
+                cities[city_id] = cities.get(city_id, False) or \
+                    obj not in session.new
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _bump_changed_versions(session):
+    changes = session.info.pop('changed_resources', None)
+    pending = bump_resource_versions(changes)
+    PendingBump.save([change for change in changes or ()
+                      if change in pending])
+    invalidate_identities(session.info.pop('changed_users', ()))
+    cities = session.info.pop('changed_cities', {})
+    invalidate_companies_in_cities([city_id for city_id, drop in
+                                    cities.items() if drop])
+    invalidate_companies_in_cities([city_id for city_id, drop in
+                                    cities.items() if not drop], drop=False)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('changed_resources', None)
+    session.info.pop('changed_users', None)
+    session.info.pop('changed_cities', None)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    identity = User.load_identity(int(user_id))
+    if identity is None or identity['deleted']:
+        return None
+    return CachedUser(identity)
 
 
 login_manager.anonymous_user = Anonymous
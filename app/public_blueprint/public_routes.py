@@ -2,6 +2,7 @@ from flask import request, jsonify
 from flask_login import login_user, logout_user, login_required
 
 from ..auth import su_auth, UserType
+from ..hashing import hashing_stats
 from ..models import User, Company, db
 from ..public_blueprint import login_api
 from ..utils import is_all_type, is_valid_string, https_url_for, \
@@ -58,12 +59,16 @@ def get_all_endpoints():
                         'get_product': https_url_for('api.get_product', product_id=0),
                         'remove_product': https_url_for('api.delete_product'),
                         'add_product': https_url_for('api.new_product'),
+                        'import_products': https_url_for('api.import_products'),
                         'get_orders': https_url_for('api.get_orders'),
                         'count_orders': https_url_for('api.order_count'),
+                        'export_orders': https_url_for('api.export_orders'),
+                        'sales_report': https_url_for('api.sales_report'),
                         'confirm_order': https_url_for('api.confirm_customer_order'),
                         'get_customer_order': https_url_for('api.get_customer_orders',
                                                             order_id=0),
                         'add_order': https_url_for('api.new_customer_order'),
+                        'add_orders': https_url_for('api.new_customer_orders'),
                         'remove_order': https_url_for('api.delete_order'),
                         'upload_images': https_url_for('api.upload_image_route'),
                         'ping': https_url_for('login.echo_ping'),
@@ -73,6 +78,12 @@ def get_all_endpoints():
     return response
 
 
+@login_api.route('/metrics/password_hashing', methods=['GET'])
+@su_auth.login_required
+def password_hashing_metrics():
+    return send_response(200, hashing_stats())
+
+
 @login_api.route('/ping', methods=['GET'])
 def echo_ping():
     return send_response(200, 'OK')
@@ -1,12 +1,10 @@
-import json
 import logging
 import os
 import uuid
 from datetime import date
 from functools import partial
 
-import redis
-from flask import url_for as http_url_for, jsonify
+from flask import url_for as http_url_for, jsonify, current_app
 from flask_uploads import UploadNotAllowed
 
 log_cfg = os.path.join(os.getcwd(), 'logs', 'all_logs.txt')
@@ -14,11 +12,6 @@ logging.basicConfig(filename=log_cfg, filemode='a+',
                     format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
 https_url_for = partial(http_url_for, _scheme='https', _external=True)
 
-cache_pass,port_number=os.environ.get('redis_pass'),int(os.environ.get('redis_port'))
-data_cache = redis.StrictRedis(password=cache_pass,port=port_number)
-# data_cache = redis.StrictRedis()
-tragel_companies_tag = 'tragel:companies'
-
 
 
 class SearchType:
@@ -93,12 +86,8 @@ def upload(upload_object, request_object, company_id, data) -> dict:
     return {'error': 'Image contain invalid data'}
 
 
-def cache_companies_result(new_company, query):
-    cache = data_cache.hget(tragel_companies_tag, query)
-    if cache is None:
-        data_cache.hset(tragel_companies_tag, query, json.dumps(
-            [new_company.to_json(with_isoformat=True)]))
-    else:
-        cache = json.loads(cache.decode('utf-8'))
-        cache.append(new_company.to_json(with_isoformat=True))
-        data_cache.hset(tragel_companies_tag, query, json.dumps(cache))
+def send_encoded_response(status_code, encoded_message):
+    """Same as `send_response`, for a message that is already encoded."""
+    body = '{{"status":{},"message":{}}}'.format(status_code, encoded_message)
+    return current_app.response_class(body, status=status_code,
+                                      mimetype='application/json')
@@ -1,15 +1,17 @@
 from datetime import datetime
 
-from flask import render_template, redirect, flash, request, jsonify
+from flask import render_template, redirect, flash, request, jsonify, \
+    current_app
 from flask_login import logout_user, login_user, current_user, login_required
 
 from . import web_admin
 from .forms import AdminLoginForm, CompanyRegistrationForm, \
     CreateSubscriptionForm, BranchAddForm
 from ..decorators import sudo_required, UserType
-from ..models import User, Country, State, City, Company, db, Product, \
-    Subscription
-from ..utils import https_url_for, cache_companies_result
+from ..geography import get_geography
+from ..models import User, Company, db, Product, Subscription
+from ..cache import cache_company
+from ..utils import https_url_for, send_response
 
 
 @web_admin.route('/', methods=['GET', 'POST'])
@@ -46,7 +48,7 @@ def suspend_company():  # to-do
 @sudo_required
 def list_companies():
     query = Company.query.filter_by(headquarter_id=None)
-    companies = [company.to_json() for company in query.all()]
+    companies = Company.to_json_list(query.all())
     return render_template('all_companies.html', companies=companies,
                            total=len(companies))
 
@@ -56,7 +58,7 @@ def list_companies():
 def list_branches():
     hq_id = request.args.get('hqid', type=int)
     hq = Company.query.filter_by(id=hq_id).first()
-    branches = [branch.to_json() for branch in hq.branches]
+    branches = Company.to_json_list(hq.branches)
     return render_template('all_branches.html', companies=branches,
                            total=len(branches), company_name=hq.name)
 
@@ -65,10 +67,10 @@ def list_branches():
 @sudo_required
 def create_company():
     form = CompanyRegistrationForm()
-    form.country.choices = [(country.id, country.name) for country in
-                            Country.query.all()]
-    form.state.choices = [(state.id, state.name) for state in State.query.all()]
-    form.city.choices = [(city.id, city.name) for city in City.query.all()]
+    geography = get_geography()
+    form.country.choices = geography.country_choices
+    form.state.choices = geography.state_choices
+    form.city.choices = geography.city_choices
     if form.validate_on_submit():
         company_name, email = form.name.data, form.email.data
         address, city_id = form.address.data, form.city.data
@@ -88,9 +90,7 @@ def create_company():
             company_admin.username += ("@" + str(new_company.id))
             db.session.add(company_admin)
             db.session.commit()
-            city = City.query.get(city_id)
-            query = city.state.name + '~' + city.name
-            cache_companies_result(new_company, query)
+            cache_company(new_company)
             flash('Company added successfully')
             return redirect(https_url_for('web_client.create_company'))
         except Exception as e:
@@ -103,10 +103,10 @@ def create_company():
 @sudo_required
 def create_branch():
     form = BranchAddForm()
-    form.country.choices = [(country.id, country.name) for country in
-                            Country.query.all()]
-    form.state.choices = [(state.id, state.name) for state in State.query.all()]
-    form.city.choices = [(city.id, city.name) for city in City.query.all()]
+    geography = get_geography()
+    form.country.choices = geography.country_choices
+    form.state.choices = geography.state_choices
+    form.city.choices = geography.city_choices
     hq_id = request.args.get('hqid', -1, type=int)
     if hq_id == -1:
         flash('Please select a company to add branch to')
@@ -130,10 +130,7 @@ def create_branch():
             branch_admin.username += ("@" + str(branch.id))
             db.session.add(branch_admin)
             db.session.commit()
-
-            city = City.query.get(city_id)
-            query = city.state.name + '~' + city.name
-            cache_companies_result(branch, query)
+            cache_company(branch)
 
             flash('Branch added successfully')
             return redirect(https_url_for('web_client.list_companies'))
@@ -154,20 +151,29 @@ def add_subscription():
     return render_template('create_subscription.html', form=form)
 
 
+def _geography_response(body, visibility):
+    """The geography JSON `body`, which browsers may keep for a day, and
+    shared caches too when `visibility` is 'public'. An unknown location
+    answers a 404 that is not cached."""
+    if body is None:
+        return send_response(404, 'Location not found')
+    response = current_app.response_class(body, mimetype='application/json')
+    response.headers['Cache-Control'] = '{}, max-age=86400'.format(visibility)
+    return response
+
+
 @web_admin.route('/_get_states', methods=['GET'])
 @login_required
 def _get_states():
     country_id = request.args.get('country_id', 1, type=int)
-    country = Country.query.filter_by(id=country_id).first()
-    states = [(state.id, state.name) for state in country.states]
-    return jsonify(states)
+    return _geography_response(get_geography().states_json(country_id),
+                               'private')
 
 
 @web_admin.route('/_get_countries', methods=['GET'])
 @login_required
 def _get_countries():
-    countries = [(country.id, country.name) for country in Country.query.all()]
-    return jsonify(countries)
+    return _geography_response(get_geography().countries_json, 'private')
 
 
 @web_admin.route('/_get_key', methods=['GET'])
@@ -192,9 +198,8 @@ def _get_key():
 @sudo_required
 def _get_products():
     company_id = request.args.get('company_id', 1, type=int)
-    products = [product.to_json() for product in
-                Product.query.with_deleted().filter_by(
-                    company_id=company_id).all()]
+    products = Product.rows_to_json(Product.query.with_deleted().filter_by(
+        company_id=company_id).with_entities(*Product.json_columns()))
     return jsonify(products)
 
 
@@ -216,8 +221,8 @@ def _get_subscriptions():
     if last_subscription is None:
         text = 'No subscriptions yet'
     else:
-        start_date = last_subscription.begin_date.date()
-        to_date = last_subscription.end_date.date()
+        start_date = last_subscription.begin_date
+        to_date = last_subscription.end_date
         text = 'Between {} and {}'.format(start_date, to_date)
     return jsonify({'last': text})
 
@@ -225,9 +230,8 @@ def _get_subscriptions():
 @web_admin.route('/_get_cities', methods=['GET'])
 def _get_cities():
     state_id = request.args.get('state_id', 1, type=int)
-    state = State.query.filter_by(id=state_id).first()
-    cities = [(city.id, city.name) for city in state.cities]
-    return jsonify(cities)
+    return _geography_response(get_geography().cities_json(state_id),
+                               'public')
 
 
 @web_admin.route('/logout')
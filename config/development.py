@@ -7,3 +7,5 @@ IGNORE_AUTH = True
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'tragel.db')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SECRET_KEY = 'top-secret-key'
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:50000'
+PASSWORD_SALT_LENGTH = 16
@@ -5,3 +5,6 @@ TESTING = True
 SECRET_KEY = 'top-secret!'
 SERVER_NAME = ''
 SQLALCHEMY_DATABASE_URI = ''
+PASSWORD_HASH_POOL = 'inline'
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+PASSWORD_SALT_LENGTH = 16
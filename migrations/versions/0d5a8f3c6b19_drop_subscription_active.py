@@ -0,0 +1,37 @@
+"""drop companies.subscription_active (user-021)
+
+Whether a company is subscribed is read from companies.active_until, and
+nothing reads the flag any more.
+
+Revision ID: 0d5a8f3c6b19
+Revises: 1e7b4d9a2c68
+Create Date: 2026-10-18 11:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d5a8f3c6b19'
+down_revision = '1e7b4d9a2c68'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('companies') as batch_op:
+        batch_op.drop_column('subscription_active')
+
+
+def downgrade():
+    with op.batch_alter_table('companies') as batch_op:
+        batch_op.add_column(sa.Column('subscription_active', sa.Boolean(),
+                                      server_default=sa.false(),
+                                      nullable=False))
+    companies = sa.table('companies',
+                         sa.column('active_until', sa.Date()),
+                         sa.column('subscription_active', sa.Boolean()))
+    op.execute(companies.update()
+               .where(companies.c.active_until >= sa.func.current_date())
+               .values(subscription_active=True))
@@ -0,0 +1,28 @@
+"""token generation of the users (user-016)
+
+Revision ID: 1e7b4d9a2c68
+Revises: 4a9e6c2d7b05
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e7b4d9a2c68'
+down_revision = '4a9e6c2d7b05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the server default fills in the existing users
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('token_generation', sa.Integer(),
+                                      server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('token_generation')
@@ -0,0 +1,35 @@
+"""subscription end date of the companies (user-020)
+
+Revision ID: 2b6e9a4f8c13
+Revises: 9d4c7b1e3a58
+Create Date: 2026-10-18 09:04:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b6e9a4f8c13'
+down_revision = '9d4c7b1e3a58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('companies') as batch_op:
+        batch_op.add_column(sa.Column('active_until', sa.Date(),
+                                      nullable=True))
+
+    # the end date of the latest subscription of every company
+    op.execute("""
+        UPDATE companies SET active_until = (
+            SELECT subscriptions.end_date FROM subscriptions
+            WHERE subscriptions.company_id = companies.id
+            ORDER BY subscriptions.id DESC LIMIT 1)
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('companies') as batch_op:
+        batch_op.drop_column('active_until')
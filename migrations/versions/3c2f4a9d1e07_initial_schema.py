@@ -0,0 +1,165 @@
+"""initial schema
+
+The tables as db.create_all() built them before the migrations existed.
+
+Revision ID: 3c2f4a9d1e07
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c2f4a9d1e07'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'countries',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=128), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name'))
+    op.create_table(
+        'states',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=128), nullable=False),
+        sa.Column('country_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['country_id'], ['countries.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name'))
+    op.create_table(
+        'cities',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=128), nullable=False),
+        sa.Column('state_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['state_id'], ['states.id']),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_table(
+        'companies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=128), nullable=False),
+        sa.Column('official_email', sa.String(length=128), nullable=True),
+        sa.Column('address', sa.String(length=256), nullable=False),
+        sa.Column('city_id', sa.Integer(), nullable=False),
+        sa.Column('date_of_creation', sa.DateTime(), nullable=False),
+        sa.Column('subscription_active', sa.Boolean(), nullable=False),
+        sa.Column('headquarter_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['city_id'], ['cities.id']),
+        sa.ForeignKeyConstraint(['headquarter_id'], ['companies.id']),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_companies_id', 'companies', ['id'], unique=True)
+    op.create_index('ix_companies_name', 'companies', ['name'])
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('fullname', sa.String(length=128), nullable=False),
+        sa.Column('username', sa.String(length=64), nullable=False),
+        sa.Column('personal_email', sa.String(length=128), nullable=True),
+        sa.Column('address', sa.String(length=128), nullable=True),
+        sa.Column('password_hash', sa.String(length=128), nullable=False),
+        sa.Column('company_id', sa.Integer(), nullable=True),
+        sa.Column('role', sa.SmallInteger(), nullable=False),
+        sa.Column('deleted', sa.Boolean(), nullable=False),
+        sa.Column('is_confirmed', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['company_id'], ['companies.id']),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_users_username', 'users', ['username'], unique=True)
+    op.create_index('ix_users_personal_email', 'users', ['personal_email'],
+                    unique=True)
+    op.create_index('ix_users_password_hash', 'users', ['password_hash'])
+    op.create_table(
+        'products',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=64), nullable=False),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('thumbnail', sa.String(length=128), nullable=True),
+        sa.Column('category', sa.String(length=256), nullable=False),
+        sa.Column('description', sa.String(length=256), nullable=False),
+        sa.Column('company_id', sa.Integer(), nullable=True),
+        sa.Column('deleted', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['company_id'], ['companies.id']),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_products_name', 'products', ['name'])
+    op.create_table(
+        'orders',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('staff_id', sa.Integer(), nullable=True),
+        sa.Column('date_of_order', sa.DateTime(), nullable=True),
+        sa.Column('payment_type', sa.Integer(), nullable=False),
+        sa.Column('payment_reference', sa.Text(), nullable=False),
+        sa.Column('company_id', sa.Integer(), nullable=True),
+        sa.Column('deleted', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['company_id'], ['companies.id']),
+        sa.ForeignKeyConstraint(['staff_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('payment_reference'))
+    op.create_index('ix_orders_staff_id', 'orders', ['staff_id'])
+    op.create_table(
+        'items',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=True),
+        sa.Column('product_id', sa.Integer(), nullable=True),
+        sa.Column('quantity', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.id']),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id']),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_items_order_id', 'items', ['order_id'])
+    op.create_index('ix_items_product_id', 'items', ['product_id'])
+    op.create_table(
+        'stocks',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('stock_time', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('stock_time'))
+    op.create_index('ix_stocks_product_id', 'stocks', ['product_id'])
+    op.create_table(
+        'confirmations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('confirmed', sa.Boolean(), nullable=False),
+        sa.Column('admin_id', sa.Integer(), nullable=True),
+        sa.Column('order_id', sa.Integer(), nullable=True),
+        sa.Column('date', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('order_id'))
+    op.create_table(
+        'subscriptions',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('token', sa.Text(), nullable=False),
+        sa.Column('begin_date', sa.Date(), nullable=False),
+        sa.Column('end_date', sa.Date(), nullable=False),
+        sa.Column('company_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['company_id'], ['companies.id']),
+        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('subscriptions')
+    op.drop_table('confirmations')
+    op.drop_index('ix_stocks_product_id', table_name='stocks')
+    op.drop_table('stocks')
+    op.drop_index('ix_items_product_id', table_name='items')
+    op.drop_index('ix_items_order_id', table_name='items')
+    op.drop_table('items')
+    op.drop_index('ix_orders_staff_id', table_name='orders')
+    op.drop_table('orders')
+    op.drop_index('ix_products_name', table_name='products')
+    op.drop_table('products')
+    op.drop_index('ix_users_password_hash', table_name='users')
+    op.drop_index('ix_users_personal_email', table_name='users')
+    op.drop_index('ix_users_username', table_name='users')
+    op.drop_table('users')
+    op.drop_index('ix_companies_name', table_name='companies')
+    op.drop_index('ix_companies_id', table_name='companies')
+    op.drop_table('companies')
+    op.drop_table('cities')
+    op.drop_table('states')
+    op.drop_table('countries')
@@ -0,0 +1,29 @@
+"""version bumps waiting for Redis (user-023)
+
+Revision ID: 3f8c1a7d5e42
+Revises: 7b2e5c9f1a36
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8c1a7d5e42'
+down_revision = '7b2e5c9f1a36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'pending_bumps',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('resource', sa.String(length=64), nullable=False),
+        sa.Column('company_id', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('pending_bumps')
@@ -0,0 +1,32 @@
+"""idempotency key of the orders (user-025)
+
+Revision ID: 4a9e6c2d7b05
+Revises: 8c3d1f6b2a74
+Create Date: 2026-10-18 09:07:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4a9e6c2d7b05'
+down_revision = '8c3d1f6b2a74'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('orders') as batch_op:
+        batch_op.add_column(sa.Column('idempotency_key', sa.String(length=64),
+                                      nullable=True))
+        batch_op.create_unique_constraint(
+            'uq_orders_company_idempotency_key',
+            ['company_id', 'idempotency_key'])
+
+
+def downgrade():
+    with op.batch_alter_table('orders') as batch_op:
+        batch_op.drop_constraint('uq_orders_company_idempotency_key',
+                                 type_='unique')
+        batch_op.drop_column('idempotency_key')
@@ -0,0 +1,56 @@
+"""daily sales rollup (user-009)
+
+Revision ID: 5e8b3f0a6d21
+Revises: 7a1d5e2b9c40
+Create Date: 2026-10-18 09:02:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8b3f0a6d21'
+down_revision = '7a1d5e2b9c40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'daily_sales',
+        sa.Column('company_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('payment_type', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('revenue', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['company_id'], ['companies.id']),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id']),
+        sa.PrimaryKeyConstraint('company_id', 'day', 'product_id',
+                                'payment_type'))
+
+    # fill the rollup from the orders recorded so far; SQLite casts
+    # '2019-05-01 10:00:00' to the integer 2019, date() gives the day
+    if op.get_bind().dialect.name == 'sqlite':
+        day = 'date(orders.date_of_order)'
+    else:
+        day = 'CAST(orders.date_of_order AS DATE)'
+    op.execute("""
+        INSERT INTO daily_sales (company_id, day, product_id, payment_type,
+                                 quantity, revenue)
+        SELECT orders.company_id, {day},
+               items.product_id, orders.payment_type,
+               SUM(COALESCE(items.quantity, 1)),
+               SUM(COALESCE(items.quantity, 1) * products.price)
+        FROM orders
+        JOIN items ON items.order_id = orders.id
+        JOIN products ON products.id = items.product_id
+        WHERE orders.deleted = false
+        GROUP BY orders.company_id, {day},
+                 items.product_id, orders.payment_type
+    """.format(day=day))
+
+
+def downgrade():
+    op.drop_table('daily_sales')
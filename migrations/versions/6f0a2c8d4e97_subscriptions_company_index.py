@@ -0,0 +1,26 @@
+"""latest subscription index (user-021)
+
+Revision ID: 6f0a2c8d4e97
+Revises: 2b6e9a4f8c13
+Create Date: 2026-10-18 09:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f0a2c8d4e97'
+down_revision = '2b6e9a4f8c13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_subscriptions_company_latest', 'subscriptions',
+                    ['company_id', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_subscriptions_company_latest',
+                  table_name='subscriptions')
@@ -0,0 +1,31 @@
+"""order search indexes (user-008)
+
+Revision ID: 7a1d5e2b9c40
+Revises: 3c2f4a9d1e07
+Create Date: 2026-10-18 09:01:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a1d5e2b9c40'
+down_revision = '3c2f4a9d1e07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_orders_company_date', 'orders',
+                    ['company_id', 'date_of_order'])
+    op.create_index('ix_orders_company_staff_date', 'orders',
+                    ['company_id', 'staff_id', 'date_of_order'])
+    op.create_index('ix_orders_company_payment_date', 'orders',
+                    ['company_id', 'payment_type', 'date_of_order'])
+
+
+def downgrade():
+    op.drop_index('ix_orders_company_payment_date', table_name='orders')
+    op.drop_index('ix_orders_company_staff_date', table_name='orders')
+    op.drop_index('ix_orders_company_date', table_name='orders')
@@ -0,0 +1,30 @@
+"""unit price of the order items (user-009)
+
+The price of the items of the orders taken before this revision is not
+known any more, so it stays NULL: the daily sales fall back to the
+current price of the product for them, as they did before.
+
+Revision ID: 7b2e5c9f1a36
+Revises: 0d5a8f3c6b19
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e5c9f1a36'
+down_revision = '0d5a8f3c6b19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('items') as batch_op:
+        batch_op.add_column(sa.Column('price', sa.Float(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('items') as batch_op:
+        batch_op.drop_column('price')
@@ -0,0 +1,56 @@
+"""digest of the subscription tokens (user-022)
+
+Revision ID: 8c3d1f6b2a74
+Revises: 6f0a2c8d4e97
+Create Date: 2026-10-18 09:06:00.000000
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3d1f6b2a74'
+down_revision = '6f0a2c8d4e97'
+branch_labels = None
+depends_on = None
+
+subscriptions = sa.table('subscriptions', sa.column('id', sa.Integer),
+                         sa.column('token', sa.Text),
+                         sa.column('token_digest', sa.String))
+
+
+def upgrade():
+    with op.batch_alter_table('subscriptions') as batch_op:
+        batch_op.add_column(sa.Column('token_digest', sa.String(length=64),
+                                      nullable=True))
+
+    # hash the tokens redeemed so far, a chunk at a time
+    connection = op.get_bind()
+    update = subscriptions.update()\
+        .where(subscriptions.c.id == sa.bindparam('_id'))\
+        .values(token_digest=sa.bindparam('_digest'))
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([subscriptions.c.id, subscriptions.c.token])
+            .where(subscriptions.c.id > last_id)
+            .order_by(subscriptions.c.id).limit(1000)).fetchall()
+        if not rows:
+            break
+        connection.execute(update, [
+            {'_id': id_, '_digest': hashlib.sha256(
+                token.encode('utf-8')).hexdigest()} for id_, token in rows])
+        last_id = rows[-1][0]
+
+    # fails if a token was redeemed twice before the constraint existed
+    op.create_index('ix_subscriptions_token_digest', 'subscriptions',
+                    ['token_digest'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_subscriptions_token_digest', table_name='subscriptions')
+    with op.batch_alter_table('subscriptions') as batch_op:
+        batch_op.drop_column('token_digest')
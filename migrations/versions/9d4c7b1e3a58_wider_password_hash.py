@@ -0,0 +1,33 @@
+"""wider password hashes (user-018)
+
+Revision ID: 9d4c7b1e3a58
+Revises: 5e8b3f0a6d21
+Create Date: 2026-10-18 09:03:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4c7b1e3a58'
+down_revision = '5e8b3f0a6d21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # scrypt hashes are longer than 128 characters
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column('password_hash',
+                              existing_type=sa.String(length=128),
+                              type_=sa.String(length=256),
+                              existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column('password_hash',
+                              existing_type=sa.String(length=256),
+                              type_=sa.String(length=128),
+                              existing_nullable=False)
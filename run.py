@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from werkzeug.security import generate_password_hash, check_password_hash
 
 from app import create_app, db
-from app.models import User, Company, Country, State, City
+from app.models import User, Company, Country, State, City, DailySale, \
+    Subscription
 from app.decorators import UserType
+from app.geography import get_geography, reset_geography
 
 app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
 
@@ -25,6 +32,7 @@ def add_country():
         country.states.append(state)
     db.session.add(country)
     db.session.commit()
+    reset_geography()
 
 
 @app.before_first_request
@@ -32,6 +40,7 @@ def first_request():
     db.create_all()
     if Country.query.get(1) is None:
         add_country()
+    get_geography()
     if User.query.get(1) is None:
         company = Company(name='General Public', address='', city_id=301)
         super_user = User(fullname='Joshua', username='iamOgunyinka',
@@ -42,3 +51,64 @@ def first_request():
         db.session.add(super_user)
         db.session.commit()
 
+
+@app.cli.command('backfill-sales')
+@click.option('--company', type=int, default=None,
+              help='Only rebuild the sales of this company')
+def backfill_sales(company):
+    """Rebuild the daily sales rollup from the recorded orders."""
+    rows = DailySale.backfill(company)
+    click.echo('{} daily sales rows written'.format(rows))
+
+
+@app.cli.command('benchmark-hashing')
+@click.option('--method', 'methods', multiple=True,
+              help='Hash method to measure, e.g. pbkdf2:sha256:600000 or '
+                   'scrypt:32768:8:1; may be repeated. Defaults to the '
+                   'configured PASSWORD_HASH_METHOD.')
+@click.option('--seconds', type=float, default=3.0,
+              help='How long to measure each method')
+def benchmark_hashing(methods, seconds):
+    """Measure the password checks per second, i.e. the logins per second,
+    of hash parameters, on one core and on all of them."""
+    cores = os.cpu_count() or 1
+    salt_length = app.config.get('PASSWORD_SALT_LENGTH', 16)
+    for method in methods or [app.config.get('PASSWORD_HASH_METHOD',
+                                             'scrypt')]:
+        password_hash = generate_password_hash('benchmark', method,
+                                               salt_length)
+        per_core = _checks_per_second(password_hash, seconds, 1)
+        all_cores = _checks_per_second(password_hash, seconds, cores)
+        click.echo('{:<24} {:>8.1f} ms/login {:>8.1f} logins/s/core '
+                   '{:>8.1f} logins/s on {} cores'.format(
+                       method, 1000.0 / per_core, per_core, all_cores, cores))
+
+
+def _checks_per_second(password_hash, seconds, threads):
+    def check():
+        checks = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            check_password_hash(password_hash, 'benchmark')
+            checks += 1
+        return checks
+
+    with ThreadPoolExecutor(threads) as executor:
+        futures = [executor.submit(check) for _ in range(threads)]
+        return sum(future.result() for future in futures) / seconds
+
+
+@app.cli.command('backfill-subscriptions')
+def backfill_subscriptions():
+    """Set the subscription end date of every company from its latest
+    subscription."""
+    rows = Company.backfill_active_until()
+    click.echo('{} companies updated'.format(rows))
+
+
+@app.cli.command('backfill-token-digests')
+def backfill_token_digests():
+    """Compute the digests of the subscription tokens redeemed before they
+    were stored."""
+    rows = Subscription.backfill_token_digests()
+    click.echo('{} subscriptions updated'.format(rows))
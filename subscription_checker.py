@@ -1,6 +1,5 @@
-from app.models import Company, Subscription, db
+from app.models import Company
 from app import create_app
-from datetime import datetime
 
 
 app = create_app('production')
@@ -8,13 +7,9 @@ app = create_app('production')
 
 if __name__ == '__main__':
     with app.app_context():
-        all_companies = Company.query.all()
-        for company in all_companies:
-            last_subscription = Subscription.query.filter_by(
-                company_id=company.id).order_by(Subscription.id.desc()).first()
-            expired = last_subscription is None or last_subscription\
-                .end_date.date() < datetime.utcnow().date()
-            if expired:
-                company.subscription_active = False
-            db.session.add(company)
-        db.session.commit()
+        # whether a company is subscribed is read from its `active_until`
+        # date, so nothing expires here: the job only repairs the dates
+        # that differ from the latest subscription
+        updated = Company.backfill_active_until(
+            app.config.get('SUBSCRIPTION_CHECK_CHUNK_SIZE', 10000))
+        print('{} companies updated'.format(updated))
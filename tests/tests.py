@@ -1,8 +1,32 @@
+import base64
+import csv
+import io
+import json
+import os
+import tempfile
+import time
 import unittest
+import uuid
+from unittest import mock
+from datetime import datetime, timedelta
+import redis
+from flask import jsonify
+from flask_login.utils import _create_identifier
+from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import NotFound
+from werkzeug.security import generate_password_hash, check_password_hash
 from app import create_app, db
-from app.models import User, Order
+from app.models import User, Order, Item, Company, Product, Subscription, \
+    CachedUser, DailySale, PendingBump, Confirmation, Country, State, City, \
+    load_user
 from app.auth import UserType
+from app import cache
+from app.cache import CircuitBreaker
+from app.decorators import etag, rate_limit
+from app.decorators.paginate import encode_cursor, decode_cursor
+from app.decorators.rate_limit import SharedMemRateLimit, RedisRateLimit
+from app.geography import reset_geography
+from app.hashing import HashingPool, needs_rehash
 from .test_client import TestClient
 
 
@@ -22,6 +46,30 @@ class TestAPI(unittest.TestCase):
         db.session.add(u)
         db.session.commit()
         self.client = TestClient(self.app, u)
+        # every test starts with fresh rate limiting counters
+        rate_limit._limiter = None
+
+    def login(self, user):
+        """A test client with `user` logged in."""
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+            session['_id'] = _create_identifier()
+        return client
+
+    def subscribed_company(self):
+        """A company with a running subscription, administered by the
+        default user."""
+        today = datetime.utcnow().date()
+        company = Company(name='Company', address='Address', city_id=1)
+        company.staffs.append(User.query.get(1))
+        company.add_subscription(Subscription(
+            begin_date=today, end_date=today + timedelta(days=30),
+            token='subscription'))
+        db.session.add(company)
+        db.session.commit()
+        return company
 
     def tearDown(self):
         db.session.remove()
@@ -230,3 +278,622 @@ class TestAPI(unittest.TestCase):
         self.assertTrue(len(json['customers']) == 25)
         self.assertTrue(json['customers'][0]['name'] == customers[0].name)
         self.assertTrue(json['customers'][24]['name'] == customers[24].name)
+
+    def test_orders_by_username(self):
+        company = self.subscribed_company()
+        db.session.add(Order(staff_id=1, payment_type=0, company_id=company.id,
+                             payment_reference='ref-1'))
+        db.session.commit()
+        client = self.login(User.query.get(1))
+        rv = client.get('/api/v1/orders/?search_type=2&username=' +
+                        self.default_username)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(rv.get_json()['orders']) == 1)
+
+        # an unknown username gives an empty page
+        rv = client.get('/api/v1/orders/?search_type=2&username=nobody')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.get_json()['orders'] == [])
+
+    def test_export_orders(self):
+        company = self.subscribed_company()
+        rice = Product(name='Rice', price=2.5, category='', description='',
+                       company_id=company.id)
+        db.session.add(rice)
+        db.session.commit()
+        day = datetime(2019, 5, 1, 10, 30)
+        # a confirmed order with items, and one with neither items, staff
+        # nor confirmation date
+        db.session.add(Order(staff_id=1, payment_type=0, company_id=company.id,
+                             payment_reference='ref-1', date_of_order=day,
+                             items=[Item(product_id=rice.id, quantity=3)],
+                             payment_confirmed=Confirmation(
+                                 confirmed=True, admin_id=1, date=day)))
+        db.session.add(Order(payment_type=1, company_id=company.id,
+                             payment_reference='ref-2', date_of_order=day,
+                             payment_confirmed=Confirmation(
+                                 confirmed=True, admin_id=1)))
+        db.session.commit()
+        client = self.login(User.query.get(1))
+
+        rv = client.get('/api/v1/orders/export?format=ndjson')
+        self.assertTrue(rv.status_code == 200)
+        lines = [json.loads(line) for line in rv.get_data(as_text=True)
+                 .splitlines()]
+        self.assertTrue(len(lines) == 2)
+        self.assertTrue(lines[0]['staff'] == 'Joshua')
+        self.assertTrue(lines[0]['items'] == [
+            {'product': 'Rice', 'quantity': 3, 'price': 2.5}])
+        self.assertTrue(lines[0]['confirmation'] == {
+            'confirmed': True, 'by': 'Joshua', 'date': day.isoformat()})
+        self.assertTrue(lines[1]['staff'] is None)
+        self.assertTrue(lines[1]['items'] == [])
+        self.assertTrue(lines[1]['confirmation']['date'] is None)
+
+        rv = client.get('/api/v1/orders/export?format=csv')
+        self.assertTrue(rv.status_code == 200)
+        rows = list(csv.reader(io.StringIO(rv.get_data(as_text=True))))
+        self.assertTrue(len(rows) == 3)
+        self.assertTrue(rows[1][2] == 'Joshua' and rows[1][5] == 'Rice')
+        self.assertTrue(rows[1][6] == '3' and rows[1][10] == day.isoformat())
+        self.assertTrue(rows[2][2] == '' and rows[2][5] == '')
+        self.assertTrue(rows[2][10] == '')
+
+        rv = client.get('/api/v1/orders/export?format=xml')
+        self.assertTrue(rv.status_code == 400)
+
+    def test_batched_order_serializer(self):
+        staff = User(fullname='Staff', username='staff', password='password',
+                     role=UserType.BasicUser, deleted=True)
+        rice = Product(name='Rice', price=10.0, category='', description='',
+                       company_id=1)
+        oil = Product(name='Oil', price=5.0, category='', description='',
+                      company_id=1, deleted=True)
+        db.session.add_all([staff, rice, oil])
+        db.session.commit()
+        orders = [
+            Order(staff_id=1, payment_reference='ref-1', company_id=1,
+                  items=[Item(product_id=rice.id, quantity=2),
+                         Item(product_id=oil.id)]),
+            Order(staff_id=staff.id, payment_reference='ref-2', company_id=1,
+                  deleted=True, items=[Item(product_id=oil.id, quantity=3)]),
+            Order(staff_id=1, payment_reference='ref-3', company_id=1)]
+        db.session.add_all(orders)
+        db.session.flush()
+        db.session.add_all([
+            Confirmation(order_id=orders[0].id, confirmed=True, admin_id=1,
+                         date=datetime(2019, 5, 1, 10)),
+            Confirmation(order_id=orders[1].id, confirmed=False)])
+        db.session.commit()
+
+        # what the orders gave when serialized one query at a time
+        def order_json(order):
+            result = {
+                'id': order.id, 'payment_type': order.payment_type,
+                'staff': User.query.with_deleted().get(order.staff_id)
+                .fullname,
+                'payment_reference': order.payment_reference,
+                'date': order.date_of_order.isoformat(),
+                'items': [item.to_json()
+                          for item in order.items.order_by(Item.id)]}
+            if order.payment_confirmed is not None:
+                result['confirmation'] = order.payment_confirmed.to_json()
+            return result
+
+        self.assertTrue(Order.to_json_list(orders) ==
+                        [order_json(order) for order in orders])
+
+    def test_batched_company_serializer(self):
+        country = Country(name='Nigeria')
+        state = State(name='Lagos', country=country)
+        city = City(name='Ikeja', state=state)
+        db.session.add(city)
+        db.session.commit()
+        reset_geography()
+        headquarter = Company(name='Head', address='', city_id=city.id)
+        headquarter.staffs.append(User.query.get(1))
+        branch = Company(name='Branch', address='', city_id=city.id + 1)
+        headquarter.branches.append(branch)
+        db.session.add_all([headquarter, branch, Product(
+            name='Rice', price=1.0, category='', description='',
+            company=headquarter, deleted=True)])
+        db.session.commit()
+        companies = [headquarter, branch]
+
+        # what the companies gave when serialized one query at a time
+        def company_json(company):
+            city = City.query.get(company.city_id)
+            result = {'name': company.name, 'id': company.id,
+                      'city': city.name if city else '',
+                      'country': city.state.country.name if city else '',
+                      'staffs': len(company.staffs),
+                      'products': len(company.products),
+                      'date': company.date_of_creation.isoformat()}
+            if company.headquarter_id is None:
+                result['branches'] = len(company.branches)
+            return result
+
+        self.assertTrue(Company.to_json_list(companies, True) ==
+                        [company_json(company) for company in companies])
+
+    def test_cached_count_follows_inserts(self):
+        client = self.login(User.query.get(1))
+        rv = client.get('/api/v1/products/')
+        self.assertTrue(rv.get_json()['pages']['total'] == 0)
+        # the count cached by the first page is dropped by the insert
+        db.session.add(Product(name='Rice', price=1.0, category='',
+                               description='', company_id=None))
+        db.session.commit()
+        rv = client.get('/api/v1/products/')
+        self.assertTrue(rv.get_json()['pages']['total'] == 1)
+        self.assertTrue(rv.get_json()['pages']['total_exact'])
+
+    def test_cursor_pages_skip_undated_orders(self):
+        company = self.subscribed_company()
+        day = datetime(2019, 5, 1, 10, 30)
+        for i in range(3):
+            db.session.add(Order(staff_id=1, payment_type=0,
+                                 company_id=company.id,
+                                 payment_reference='ref-%d' % i,
+                                 date_of_order=day + timedelta(days=i)))
+        db.session.add(Order(staff_id=1, payment_type=0, company_id=company.id,
+                             payment_reference='undated', date_of_order=None))
+        db.session.commit()
+        client = self.login(User.query.get(1))
+        rv = client.get('/api/v1/orders/?all=1&cursor=&per_page=2')
+        self.assertTrue(rv.status_code == 200)
+        first = rv.get_json()
+        self.assertTrue(len(first['orders']) == 2)
+        rv = client.get('/api/v1/orders/?all=1&per_page=2&cursor=' +
+                        first['pages']['next_cursor'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(rv.get_json()['orders']) == 1)
+        self.assertTrue(rv.get_json()['pages']['next_cursor'] is None)
+
+    def test_cursor_tokens(self):
+        keyset = (Order.date_of_order, Order.id)
+        now = datetime(2019, 5, 1, 10, 30, 15, 250)
+        token = encode_cursor('n', [now, 42])
+        self.assertTrue(decode_cursor(token, keyset) == ('n', [now, 42]))
+        with self.assertRaises(ValueError):
+            decode_cursor(token, (Order.id,))
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor', keyset)
+        # every value must have the type of its column
+        for values in ([now, '42'], [now, True], [now, 4.2], [42, 42],
+                       ['2019-05-01', [42]]):
+            with self.assertRaises(ValueError):
+                decode_cursor(encode_cursor('n', values), keyset)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, retry_after=60)
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.allow())
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.failure())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.failures == 0)
+
+    def test_shared_memory_rate_limit(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            limiter = SharedMemRateLimit(path, slots=64)
+            for i in range(3):
+                allowed, remaining, reset = limiter.is_allowed('a', 3, 60)
+                self.assertTrue(allowed)
+                self.assertTrue(remaining == 2 - i)
+            allowed, remaining, _ = limiter.is_allowed('a', 3, 60)
+            self.assertFalse(allowed)
+            self.assertTrue(remaining == 0)
+
+            # another worker sees the same counters
+            other = SharedMemRateLimit(path, slots=64)
+            self.assertFalse(other.is_allowed('a', 3, 60)[0])
+            self.assertTrue(other.is_allowed('b', 3, 60)[0])
+
+            # a full stripe still accepts new keys
+            for i in range(100):
+                self.assertTrue(limiter.is_allowed('key%d' % i, 3, 60)[0])
+        finally:
+            os.remove(path)
+
+    def test_redis_rate_limit(self):
+        if cache.run(lambda client: client.ping()) is None:
+            self.skipTest('Redis is not available')
+        limiter, key = RedisRateLimit(), uuid.uuid4().hex
+        for i in range(3):
+            allowed, remaining, _ = limiter.is_allowed(key, 3, 1)
+            self.assertTrue(allowed)
+            self.assertTrue(remaining == 2 - i)
+        allowed, remaining, _ = limiter.is_allowed(key, 3, 1)
+        self.assertFalse(allowed)
+        self.assertTrue(remaining == 0)
+        # the hits were counted by Redis, not by the fallback
+        self.assertTrue(cache.run(
+            lambda client: client.zcard('tragel:rate:' + key)) == 3)
+
+        # the window slides past the hits
+        time.sleep(1.1)
+        self.assertTrue(limiter.is_allowed(key, 3, 1)[0])
+
+        # requests over the limit of the API get a 429
+        self.app.config['RATE_LIMIT_BACKEND'] = 'redis'
+        key = 'tragel:rate:api.before_request/user:1'
+        cache.run(lambda client: client.delete(key))
+        client = self.login(User.query.get(1))
+        try:
+            for i in range(5):
+                self.assertTrue(
+                    client.get('/api/v1/products/').status_code == 200)
+            self.assertTrue(client.get('/api/v1/products/').status_code == 429)
+        finally:
+            cache.run(lambda client: client.delete(key))
+
+    def test_hashing_pool(self):
+        pool = HashingPool(workers=2, mode='thread')
+        password_hash = pool.run(generate_password_hash, 'secret')
+        self.assertTrue(pool.run(check_password_hash, password_hash, 'secret'))
+        self.assertFalse(pool.run(check_password_hash, password_hash, 'wrong'))
+        stats = pool.stats()
+        self.assertTrue(stats['completed'] == 3)
+        self.assertTrue(stats['queued'] == 0 and stats['running'] == 0)
+
+    def test_rehash_on_login(self):
+        user = User.query.filter_by(username=self.default_username).first()
+        self.assertFalse(needs_rehash(user.password_hash))
+        user.password_hash = generate_password_hash(self.default_password,
+                                                    'pbkdf2:sha256:1000')
+        db.session.commit()
+        self.assertTrue(needs_rehash(user.password_hash))
+        self.assertFalse(user.verify_password('wrong'))
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:1000$'))
+        # the rehash does not commit the changes pending in the session
+        user.fullname = 'Pending'
+        self.assertTrue(user.verify_password(self.default_password))
+        self.assertFalse(needs_rehash(user.password_hash))
+        db.session.rollback()
+        self.assertTrue(user.fullname == 'Joshua')
+        db.session.expire_all()
+        user = User.query.filter_by(username=self.default_username).first()
+        self.assertFalse(needs_rehash(user.password_hash))
+        self.assertTrue(user.verify_password(self.default_password))
+
+    def test_cached_user(self):
+        user = User.query.filter_by(username=self.default_username).first()
+        cached = load_user(str(user.id))
+        self.assertTrue(isinstance(cached, CachedUser))
+        self.assertTrue(cached.id == user.id and cached.role == user.role)
+        self.assertFalse(cached.company_subscribed)
+        self.assertTrue(cached == user)
+        # columns outside of the identity come from the user itself
+        self.assertTrue(cached.personal_email == user.personal_email)
+        self.assertTrue(cached.verify_password(self.default_password))
+
+        user.deleted = True
+        db.session.commit()
+        self.assertTrue(load_user(str(user.id)) is None)
+
+    def test_subscription_expiry(self):
+        user = User.query.filter_by(username=self.default_username).first()
+        company = Company(name='Company', address='Address', city_id=1)
+        company.staffs.append(user)
+        db.session.add(company)
+        db.session.commit()
+        self.assertFalse(load_user(str(user.id)).company_subscribed)
+
+        today = datetime.utcnow().date()
+        company.add_subscription(Subscription(
+            begin_date=today - timedelta(days=30), end_date=today,
+            token='token'))
+        db.session.commit()
+        cached = load_user(str(user.id))
+        self.assertTrue(cached.active_until == today)
+        self.assertTrue(cached.company_subscribed)
+
+        # the subscription ends without any write to the company
+        company.active_until = today - timedelta(days=1)
+        self.assertFalse(user.company_subscribed)
+        db.session.rollback()
+        self.assertTrue(user.company_subscribed)
+
+        # companies not backfilled yet fall back to their subscriptions
+        db.session.execute(Company.__table__.update().values(
+            active_until=None))
+        db.session.commit()
+        self.assertTrue(user.active_until == today)
+        self.assertTrue(Company.backfill_active_until(chunk_size=1) == 1)
+        self.assertTrue(company.active_until == today)
+        self.assertTrue(Company.backfill_active_until() == 0)
+
+    def test_latest_subscription_decides(self):
+        today = datetime.utcnow().date()
+        ended = Company(name='Ended', address='', city_id=1)
+        ended.add_subscription(Subscription(
+            begin_date=today - timedelta(days=30), end_date=today,
+            token='first'))
+        ended.add_subscription(Subscription(
+            begin_date=today - timedelta(days=10),
+            end_date=today - timedelta(days=1), token='second'))
+        running = Company(name='Running', address='', city_id=1)
+        running.add_subscription(Subscription(
+            begin_date=today, end_date=today, token='third'))
+        never = Company(name='Never', address='', city_id=1)
+        db.session.add_all([ended, running, never])
+        db.session.commit()
+        self.assertTrue(ended.active_until == today - timedelta(days=1))
+        self.assertTrue(never.active_until is None)
+
+        # the subscription checker only repairs the dates that drifted
+        db.session.execute(Company.__table__.update().where(
+            Company.id == ended.id).values(active_until=today))
+        db.session.commit()
+        self.assertTrue(Company.backfill_active_until(chunk_size=2) == 1)
+        self.assertTrue(ended.active_until == today - timedelta(days=1))
+        self.assertTrue(running.active_until == today)
+
+    def test_subscription_token_digest(self):
+        today = datetime.utcnow().date()
+        subscription = Subscription(begin_date=today, end_date=today,
+                                    token='token')
+        self.assertTrue(subscription.token_digest ==
+                        Subscription.digest('token'))
+        self.assertFalse(Subscription.is_used('token'))
+        db.session.add(subscription)
+        db.session.commit()
+        self.assertTrue(Subscription.is_used('token'))
+
+        db.session.add(Subscription(begin_date=today, end_date=today,
+                                    token='token'))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        subscription.token_digest = None
+        db.session.commit()
+        self.assertTrue(Subscription.backfill_token_digests() == 1)
+        self.assertTrue(Subscription.is_used('token'))
+
+    def test_etag_keeps_view_tags(self):
+        def view():
+            response = jsonify({'status': 200})
+            response.headers['ETag'] = '"v-1"'
+            return response
+
+        with self.app.test_request_context(
+                '/', headers={'If-None-Match': '"v-2"'}):
+            self.assertTrue(etag(view)().headers['ETag'] == '"v-1"')
+        with self.app.test_request_context('/'):
+            response = etag(lambda: jsonify({'status': 200}))()
+            self.assertTrue(response.headers['ETag'] != '"v-1"')
+
+    def test_product_rows_json(self):
+        db.session.add_all([Product(name='p%d' % i, price=i, category='',
+                                    description='', company_id=1)
+                            for i in range(12)])
+        db.session.commit()
+        products = Product.query.order_by(Product.id).all()
+        with self.app.test_request_context('/'):
+            self.assertTrue(Product.rows_to_json(
+                Product.query.order_by(Product.id).with_entities(
+                    *Product.json_columns())) ==
+                [product.to_json() for product in products])
+
+    def test_bulk_product_import(self):
+        records = [(1, {'name': 'Rice', 'price': '10.5', 'cat': 'Food'}),
+                   (2, {'name': '', 'price': 1}),
+                   (3, {'name': 'Beans', 'price': 'free'}),
+                   (4, None),
+                   (5, {'name': 'Rice', 'price': 11}),
+                   (6, {'name': 'Yam', 'price': 4}),
+                   (7, {'name': 'Oil', 'price': 'nan'}),
+                   (8, {'name': 'Oil', 'price': float('inf')}),
+                   (9, {'name': 'Oil', 'price': False}),
+                   (10, {'name': 'Oil', 'price': [1]})]
+        imported, errors, failure = Product.bulk_import(records, 1,
+                                                        chunk_size=2)
+        self.assertTrue(imported == 2 and failure is None)
+        self.assertTrue([line for line, _ in errors] ==
+                        [2, 3, 4, 5, 7, 8, 9, 10])
+        self.assertTrue(Product.query.filter_by(company_id=1).count() == 2)
+
+        # names already in the catalog are rejected
+        imported, errors, failure = Product.bulk_import(
+            [(1, {'name': 'Yam', 'price': 4}), (2, {'name': 'Egg'})], 1)
+        self.assertTrue(imported == 1 and [line for line, _ in errors] == [1])
+
+        # a failure midway reports what the committed chunks saved
+        def records():
+            yield 1, {'name': 'Salt', 'price': 1}
+            yield 2, {'name': 'Sugar', 'price': 2}
+            yield 3, None
+            yield 4, {'name': 'Milk', 'price': 3}
+            raise UnicodeDecodeError('utf-8', b'', 0, 1, 'invalid')
+        imported, errors, failure = Product.bulk_import(records(), 1,
+                                                        chunk_size=2)
+        self.assertTrue(isinstance(failure, UnicodeDecodeError))
+        self.assertTrue(imported == 2 and [line for line, _ in errors] == [3])
+        self.assertTrue(Product.query.filter_by(name='Milk').count() == 0)
+
+    def test_order_batch_idempotency(self):
+        db.session.add_all([Product(name='Rice', price=10.0, category='Food',
+                                    description='', company_id=1),
+                            Product(name='Oil', price=5.0, category='Food',
+                                    description='', company_id=2)])
+        db.session.commit()
+        rice, oil = Product.query.order_by(Product.id).all()
+        batch = [{'key': 'a', 'payment_reference_id': 'cash',
+                  'items': [{'product_id': rice.id, 'quantity': 2}]},
+                 {'key': 'b', 'payment_reference_id': 'ref-b',
+                  'items': [{'product_id': rice.id}]},
+                 {'key': 'a', 'payment_reference_id': 'cash', 'items': []},
+                 {'key': 'c', 'payment_reference_id': 'ref-c',
+                  'items': [{'product_id': oil.id}]},
+                 {'payment_reference_id': 'ref-d', 'items': []}]
+        results = Order.submit_batch(batch, 1, 1)
+        self.assertTrue(results[0]['order_id'] and results[1]['order_id'])
+        self.assertTrue(results[2] == results[0])
+        self.assertTrue(results[3]['error'] == 'Unknown product')
+        self.assertTrue('error' in results[4])
+        self.assertTrue(Order.query.count() == 2)
+        self.assertTrue(Item.query.count() == 2)
+
+        # a retried batch creates nothing and gets the same results
+        self.assertTrue(Order.submit_batch(batch[:2], 1, 1) == results[:2])
+        self.assertTrue(Order.query.count() == 2)
+
+        # a reused payment reference only rejects its own order
+        results = Order.submit_batch(
+            [{'key': 'd', 'payment_reference_id': 'ref-b', 'items': []},
+             {'key': 'e', 'payment_reference_id': 'ref-e', 'items': []},
+             {'key': 'f', 'payment_reference_id': 'ref-e', 'items': []}],
+            1, 1)
+        self.assertTrue(results[0]['error'] == 'Payment reference already used')
+        self.assertTrue(results[1]['order_id'])
+        self.assertTrue(results[2]['error'] == 'Payment reference already used')
+        self.assertTrue(Order.query.count() == 3)
+
+    def test_daily_sales_keep_order_prices(self):
+        rice = Product(name='Rice', price=10.0, category='Food',
+                       description='', company_id=1)
+        db.session.add(rice)
+        db.session.commit()
+        result, = Order.submit_batch(
+            [{'key': 'a', 'payment_reference_id': 'ref-a',
+              'items': [{'product_id': rice.id, 'quantity': 2}]}], 1, 1)
+        self.assertTrue(Item.query.one().price == 10.0)
+        self.assertTrue(DailySale.query.one().revenue == 20.0)
+
+        # a later price change does not change what deleting subtracts
+        rice.price = 12.0
+        order = Order.query.get(result['order_id'])
+        DailySale.record(1, order.date_of_order.date(), order.payment_type,
+                         db.session.query(Item.product_id, Item.quantity,
+                                          Item.price), sign=-1)
+        db.session.commit()
+        sale = DailySale.query.one()
+        self.assertTrue(sale.quantity == 0 and sale.revenue == 0.0)
+
+    def test_unknown_location_not_cached(self):
+        rv = self.app.test_client().get('/web/_get_cities?state_id=999999')
+        self.assertTrue(rv.status_code == 404)
+        self.assertTrue('Cache-Control' not in rv.headers)
+
+    def test_daily_sales_backfill_by_day(self):
+        rice = Product(name='Rice', price=10.0, category='Food',
+                       description='', company_id=1)
+        db.session.add(rice)
+        db.session.commit()
+        Order.submit_batch(
+            [{'key': key, 'payment_reference_id': 'ref-' + key,
+              'items': [{'product_id': rice.id}]} for key in 'abc'], 1, 1)
+        for key, when in (('a', datetime(2019, 5, 1, 10)),
+                          ('b', datetime(2019, 5, 1, 18)),
+                          ('c', datetime(2019, 5, 2, 9))):
+            Order.query.filter_by(idempotency_key=key).update(
+                {'date_of_order': when})
+        db.session.commit()
+        self.assertTrue(DailySale.backfill(1) == 2)
+        sales = {sale.day: sale.quantity for sale in DailySale.query}
+        self.assertTrue(sales == {datetime(2019, 5, 1).date(): 2,
+                                  datetime(2019, 5, 2).date(): 1})
+
+    def test_order_products_of_the_company(self):
+        db.session.add(Product(name='Oil', price=5.0, category='Food',
+                               description='', company_id=2))
+        db.session.commit()
+        oil = Product.query.one()
+        self.assertTrue(Order.import_data(
+            {'payment_reference_id': 'ref', 'items': [{'product_id': oil.id}]},
+            1) is None)
+        _, _, items = Order.import_data(
+            {'payment_reference_id': 'ref', 'items': [{'product_id': oil.id}]},
+            2)
+        self.assertTrue(items[0].price == 5.0)
+
+    def test_token_revocation(self):
+        u = User.query.get(1)
+        access = User.generate_token(u.id, u.token_generation)
+        refresh = User.generate_token(u.id, u.token_generation, refresh=True)
+        self.assertTrue(User.verify_token(access)['id'] == u.id)
+        self.assertTrue(User.verify_token(refresh, refresh=True) is not None)
+        self.assertTrue(User.verify_token(refresh) is None)
+
+        # a new password revokes the tokens issued before it
+        u.password = 'new password'
+        db.session.commit()
+        self.assertTrue(User.verify_token(access) is None)
+        self.assertTrue(User.verify_token(refresh, refresh=True) is None)
+
+        # and so does a new role
+        access = User.generate_token(u.id, u.token_generation)
+        u.role = UserType.BasicUser
+        db.session.commit()
+        self.assertTrue(User.verify_token(access) is None)
+
+    def test_lost_bump_changes_etag(self):
+        if cache.run(lambda client: client.ping()) is None:
+            self.skipTest('Redis is not available')
+        company = self.subscribed_company()
+        client = self.login(User.query.get(1))
+        etag = client.get('/api/v1/products/').headers['ETag']
+        rv = client.get('/api/v1/products/', headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 304)
+
+        # the bump of a product write fails, and the worker that made it
+        # goes away with it
+        with mock.patch('redis.client.Pipeline.execute',
+                        side_effect=redis.ConnectionError('down')):
+            db.session.add(Product(name='Rice', price=1.0, category='',
+                                   description='', company_id=company.id))
+            db.session.commit()
+        cache._pending_bumps.clear()
+        cache._breaker = None
+        PendingBump.next_check = 0
+
+        rv = client.get('/api/v1/products/', headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['ETag'] != etag)
+        self.assertTrue(PendingBump.query.count() == 0)
+
+    def test_catalog_etag(self):
+        if cache.run(lambda client: client.ping()) is None:
+            self.skipTest('Redis is not available')
+        company = self.subscribed_company()
+        u = User.query.get(1)
+        mobile = self.app.test_client()
+        headers = {'Authorization': 'Bearer ' +
+                   User.generate_token(u.id, u.token_generation)}
+        catalog_url = '/mobile/get_products/{}'.format(company.id)
+        rv = mobile.get(catalog_url, headers=headers)
+        self.assertTrue(rv.status_code == 200)
+        etag = rv.headers['ETag']
+        rv = mobile.get(catalog_url,
+                        headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertTrue(rv.status_code == 304)
+
+        # a new product gives the catalog a new tag
+        rv = self.login(u).post('/api/v1/products/', json=[
+            {'name': 'Rice', 'price': 2.5}])
+        self.assertTrue(rv.status_code == 200)
+        rv = mobile.get(catalog_url,
+                        headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['ETag'] != etag)
+        self.assertTrue(rv.get_json()['message'][0]['name'] == 'Rice')
+
+    def test_mobile_auth_challenge(self):
+        mobile = self.app.test_client()
+        rv = mobile.get('/mobile/get_products/1',
+                        headers={'Authorization': 'Bearer not-a-token'})
+        self.assertTrue(rv.status_code == 401)
+        self.assertTrue(rv.headers['WWW-Authenticate'].startswith('Bearer'))
+        rv = mobile.get('/mobile/get_products/1', headers={
+            'Authorization': 'Basic ' + base64.b64encode(
+                b'iamOgunyinka:wrong').decode('ascii')})
+        self.assertTrue(rv.status_code == 401)
+        self.assertTrue(rv.headers['WWW-Authenticate'].startswith('Basic'))